@@ -0,0 +1,131 @@
+"""
+Memory and per-round cost of the traffic accounting, `Account` objects with lists vs `AccountStore` columns.
+
+    python -m bench.account_store [--users 100000]
+
+The memory is what the accounts of a node take, with the dict from user id to account: the old
+`Account` against the `Account` with its row in the store. The users and their map keys are
+shared by both and left out.
+
+A round is what `PortBase.upload_traffic` does: compute every diff, pick the accounts to report,
+halve the other thresholds, and reset the reported accounts.
+"""
+import random
+import time
+import tracemalloc
+from argparse import ArgumentParser
+
+from port.account import Account
+from port.account_store import AccountStore, np
+
+
+class BenchUser:
+    __slots__ = ['user_id', 'uuid']
+
+    def __init__(self, user_id):
+        self.user_id = user_id
+        self.uuid = f'uuid{user_id}'
+
+
+class LegacyAccount:
+    # the Account class before AccountStore, with the same attributes
+    SENSITIVITY_LOWER_BOUND = 100 * 1024**1
+    SENSITIVITY = 1 * 1024**2
+
+    def __init__(self, user, map_key):
+        self._user = user
+        self.map_key = map_key
+        self.traffic = [0, 0]
+        self.last_traffic = [0, 0]
+        self.threshold = self.SENSITIVITY
+        self.prev_map_key = None
+
+    def update_traffic(self, upload=None, download=None):
+        if upload is not None:
+            self.traffic[0] = max(upload, self.traffic[0])
+        if download is not None:
+            self.traffic[1] = max(download, self.traffic[1])
+
+    def reset(self):
+        self.last_traffic = self.traffic.copy()
+        self.threshold = self.SENSITIVITY
+
+    def diff(self):
+        return [self.traffic[i] - self.last_traffic[i] for i in range(2)]
+
+    def need_report(self) -> bool:
+        if sum(self.diff()) >= self.threshold:
+            return True
+        self.threshold = max(self.SENSITIVITY_LOWER_BOUND, self.threshold // 2)
+        return False
+
+
+def legacy_round(accounts):
+    to_update = dict()
+    for uid, u in accounts.items():
+        u_delta, d_delta = u.diff()
+        if u_delta + d_delta == 0:
+            continue
+        if not u.need_report():
+            continue
+        to_update[uid] = (u_delta, d_delta)
+        u.reset()
+    return len(to_update)
+
+
+def store_round(store):
+    rows, uids, u_deltas, d_deltas, n_total, n_active = store.collect(1024**2)
+    store.reset(rows)
+    return len(rows)
+
+
+def traffic(n, seed):
+    rnd = random.Random(seed)
+    # a tenth of the users are active in a round
+    return [(uid, rnd.randrange(10**9), rnd.randrange(10**9)) for uid in rnd.sample(range(n), n // 10)]
+
+
+def main():
+    parser = ArgumentParser()
+    parser.add_argument('--users', type=int, default=100000)
+    parser.add_argument('--rounds', type=int, default=5)
+    args = parser.parse_args()
+    n = args.users
+    print(f'numpy: {np is not None}')
+
+    users = [BenchUser(uid) for uid in range(n)]
+    map_keys = [f'{uid:040X}' for uid in range(n)]
+    tracemalloc.start()
+    accounts = {u.user_id: LegacyAccount(u, key) for u, key in zip(users, map_keys)}
+    legacy_mem = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    tracemalloc.start()
+    store = AccountStore()
+    new_accounts = {u.user_id: Account(u, store, map_key=key) for u, key in zip(users, map_keys)}
+    store_mem = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    rows = {uid: account.row for uid, account in new_accounts.items()}
+    print(f'accounts per user: legacy {legacy_mem / n:.0f} B, Account and store {store_mem / n:.0f} B '
+          f'({store_mem / legacy_mem:.2f}x)')
+
+    legacy_cost = store_cost = 0.
+    for r in range(args.rounds):
+        sample = traffic(n, r)
+        for uid, up, down in sample:
+            accounts[uid].update_traffic(up, down)
+        since = time.perf_counter()
+        n_legacy = legacy_round(accounts)
+        legacy_cost += time.perf_counter() - since
+
+        store.update_many('up', [rows[uid] for uid, _, _ in sample], [up for _, up, _ in sample])
+        store.update_many('down', [rows[uid] for uid, _, _ in sample], [down for _, _, down in sample])
+        since = time.perf_counter()
+        n_store = store_round(store)
+        store_cost += time.perf_counter() - since
+        assert n_legacy == n_store, (n_legacy, n_store)
+    print(f'round with {n} users: legacy {legacy_cost / args.rounds * 1000:.1f} ms, '
+          f'store {store_cost / args.rounds * 1000:.1f} ms')
+
+
+if __name__ == '__main__':
+    main()
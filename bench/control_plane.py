@@ -0,0 +1,271 @@
+"""
+Wall time, CPU, peak RSS and runtime API round trips of the stages of `HAProxy`, by number of users.
+
+    python -m bench.control_plane [--users 1000 10000 100000 500000] [--rounds 5] [--churn 0.01]
+                                  [--active 0.1] [--distribution pareto] [--properties 'combined_table delta_fetch']
+                                  [--output results.json]
+
+Every user count runs in a fresh process, so that peak RSS is its own. HAProxy is replaced by
+`bench.fake_runtime` in another process, `user_pool` and `db` by in-memory stand-ins, and the database
+of the traffic writer by SQLite. Round 0 loads every user; each round after it changes `--churn` of
+them (a third added, a third removed, a third with a new uuid) before the user sync.
+A round runs `sync_users`, plays one round of traffic in the fake HAProxy, then runs `fetch_traffic`,
+`upload_traffic` and `drain` (the writer thread's job: the spool into the database).
+The results are printed, or written to `--output`, as JSON.
+
+`HAProxy.__init__` writes /tmp/usermap, so do not run this on a node that serves users.
+"""
+from typing import *
+import os
+import sys
+import json
+import time
+import uuid
+import random
+import queue
+import shutil
+import sqlite3
+import logging
+import platform
+import resource
+import statistics
+import tempfile
+import multiprocessing
+from argparse import ArgumentParser
+
+from bench.fake_runtime import TrafficModel, serve
+
+STAGES = ['sync_users', 'fetch_traffic', 'upload_traffic', 'drain']
+
+
+class BenchUser:
+    def __init__(self, user_id, uuid):
+        self.user_id = user_id
+        self.uuid = uuid
+        self.email = f'user{user_id}@example.com'
+        self.balance = 10 * 1024**3
+        self.tag = 'default'
+
+    def __str__(self):
+        return self.email
+
+
+class BenchUserPool:
+    def __init__(self, n_users: int, seed: int = 0):
+        self.rng = random.Random(seed)
+        self.users: Dict[int, BenchUser] = dict()
+        self.next_id = 1
+        for _ in range(n_users):
+            self.add()
+
+    def add(self):
+        self.users[self.next_id] = BenchUser(self.next_id, str(uuid.UUID(int=self.rng.getrandbits(128))))
+        self.next_id += 1
+
+    def churn(self, share: float):
+        n = int(len(self.users) * share / 3)
+        picked = self.rng.sample(list(self.users), 2 * n)
+        for user_id in picked[:n]:
+            self.users.pop(user_id)
+            self.add()
+        for user_id in picked[n:]:
+            self.users[user_id] = BenchUser(user_id, str(uuid.UUID(int=self.rng.getrandbits(128))))
+
+    def all_users(self) -> List[BenchUser]:
+        return list(self.users.values())
+
+
+class BenchNode:
+    def __init__(self, properties: str):
+        self.uuid = 'bench-node'
+        self.name = 'bench'
+        self.tag = 'default'
+        self.weight = 1.
+        self.properties = properties
+        self.relay_out = list()
+
+    def can_be_used_by(self, tag) -> bool:
+        return True
+
+
+class BenchDB:
+    def __init__(self, node: BenchNode):
+        self.node = node
+
+    def get_node_by_uuid(self, node_uuid):
+        return self.node
+
+
+class BenchNetworkStatus:
+    ipv6 = None
+
+    def wait_for_checkups(self):
+        pass
+
+
+class BenchProcess:
+    # stands in for HAProxyProcess; the fake runtime is started by the benchmark
+    def __init__(self, executable, runtime, config='./haproxy_config', **kwargs):
+        self.runtime = runtime
+        self.resynced = True
+
+    def start(self) -> bool:
+        return True
+
+    def poll(self) -> bool:
+        return True
+
+    def reload(self, timeout: float = 10) -> bool:
+        return True
+
+    def check_resync(self) -> bool:
+        return True
+
+    def stop(self):
+        self.runtime.close()
+
+
+def make_writer(root: str):
+    from port.spool import TrafficSpool
+    from port.uploader import TrafficWriter, TrafficUploader
+
+    class InlineWriter(TrafficWriter):
+        # spools like TrafficWriter; the benchmark drains it as a stage of its own instead of a thread
+        def submit(self, rows: List[tuple]) -> bool:
+            self.spool.append(rows)
+            return True
+
+    def connect():
+        conn = sqlite3.connect(os.path.join(root, 'traffic.db'))
+        conn.execute('CREATE TABLE IF NOT EXISTS log (user_id, node_uuid, upload, download, ts)')
+        return conn
+
+    uploader = TrafficUploader('INSERT INTO log VALUES (?, ?, ?, ?, ?)', connect=connect, multi_row=False)
+    return InlineWriter(TrafficSpool(os.path.join(root, 'traffic_spool')), uploader)
+
+
+def table_columns(job) -> Dict[str, List[str]]:
+    # the stick tables of the config the job writes, with the columns in the order HAProxy prints them
+    tables = {table: columns for table, columns in job.traffic_tables}
+    if job.table_mode == 'migrate':
+        tables.update({'st_in': ['bytes_in_cnt'], 'st_out': ['bytes_out_cnt']})
+    if job.delta_fetch:
+        tables['st_traffic'] = ['gpt0', 'conn_cur'] + tables['st_traffic']
+    return tables
+
+
+def measure(func, runtime) -> Dict[str, float]:
+    round_trips, n_commands = runtime.n_round_trips, runtime.n_commands
+    since, cpu_since = time.perf_counter(), time.process_time()
+    func()
+    return {
+        'wall': time.perf_counter() - since,
+        'cpu': time.process_time() - cpu_since,
+        'round_trips': runtime.n_round_trips - round_trips,
+        'commands': runtime.n_commands - n_commands,
+        # KiB on Linux
+        'peak_rss_mib': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024,
+    }
+
+
+def run_users(n_users: int, args, results):
+    root = tempfile.mkdtemp(prefix='walless_bench_')
+    os.environ['WALLESS_ROOT'] = root
+    os.makedirs(os.path.join(root, 'haproxy_config'))
+    os.chdir(root)
+    logging.getLogger('walless').setLevel(logging.ERROR)
+
+    import port.port_base
+    import port.haproxy
+    from port.runtime import RuntimeAPI
+    pool = BenchUserPool(n_users, args.seed)
+    node = BenchNode(args.properties)
+    port.port_base.user_pool = pool
+    port.port_base.db = BenchDB(node)
+    port.port_base.NetworkStatus = BenchNetworkStatus
+    port.haproxy.check_output = lambda *a, **k: b'aes'
+    port.haproxy.HAProxyProcess = BenchProcess
+
+    job = port.haproxy.HAProxy(node, BenchNetworkStatus())
+    job.writer = make_writer(root)
+    job.runtime.path = os.path.join(root, 'haproxy.sock')
+    model = TrafficModel(args.active, args.mean_bytes, args.distribution, seed=args.seed)
+    server = multiprocessing.get_context('spawn').Process(
+        target=serve, args=(job.runtime.path, table_columns(job), model), daemon=True)
+    server.start()
+    while not os.path.exists(job.runtime.path):
+        time.sleep(0.05)
+    control = RuntimeAPI(job.runtime.path)
+
+    rounds = list()
+    for i in range(args.rounds + 1):
+        if i > 0:
+            pool.churn(args.churn)
+        stats = {'sync_users': measure(job.sync_users, job.runtime)}
+        control.execute('bench tick')
+        stats['fetch_traffic'] = measure(job.fetch_traffic, job.runtime)
+        stats['upload_traffic'] = measure(job.upload_traffic, job.runtime)
+        stats['drain'] = measure(job.writer.drain, job.runtime)
+        rounds.append(stats)
+        print(f'{n_users:>8} users, round {i}: ' + ', '.join(f'{stage} {stats[stage]["wall"]:.3f}s' for stage in STAGES),
+              file=sys.stderr)
+    server.terminate()
+    shutil.rmtree(root, ignore_errors=True)
+
+    results.put({
+        'users': n_users,
+        'n_active': job.n_active,
+        # the full load of round 0, and the median of the rounds after it
+        'first': rounds[0],
+        'median': {
+            stage: {key: statistics.median(r[stage][key] for r in rounds[1:]) for key in rounds[0][stage]}
+            for stage in STAGES
+        } if len(rounds) > 1 else None,
+        'rounds': rounds,
+    })
+
+
+def main():
+    parser = ArgumentParser()
+    parser.add_argument('--users', type=int, nargs='+', default=[1000, 10000, 100000, 500000])
+    parser.add_argument('--rounds', type=int, default=5, help='rounds after the one that loads every user')
+    parser.add_argument('--churn', type=float, default=0.01, help='share of the users changed in each round')
+    parser.add_argument('--active', type=float, default=0.1, help='share of the users with traffic in each round')
+    parser.add_argument('--mean-bytes', type=float, default=50 * 1024**2, help='mean traffic of an active user in a round')
+    parser.add_argument('--distribution', default='pareto', choices=['pareto', 'exp', 'uniform'])
+    parser.add_argument('--properties', default='', help='node properties, e.g. `combined_table delta_fetch`')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--output', default=None)
+    args = parser.parse_args()
+
+    ctx = multiprocessing.get_context('spawn')
+    report = {
+        'config': vars(args),
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'time': int(time.time()),
+        'results': list(),
+    }
+    for n_users in args.users:
+        results = ctx.Queue()
+        proc = ctx.Process(target=run_users, args=(n_users, args, results))
+        proc.start()
+        while True:
+            try:
+                report['results'].append(results.get(timeout=1))
+                break
+            except queue.Empty:
+                if not proc.is_alive():
+                    raise RuntimeError(f'The benchmark of {n_users} users exited with code {proc.exitcode}.')
+        proc.join()
+
+    text = json.dumps(report, indent=2)
+    if args.output is None:
+        print(text)
+    else:
+        with open(args.output, 'w') as fp:
+            fp.write(text + '\n')
+
+
+if __name__ == '__main__':
+    main()
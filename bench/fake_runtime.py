@@ -0,0 +1,225 @@
+"""
+A stand-in for the HAProxy runtime API on a Unix socket, for benchmarks.
+
+It speaks what this package sends: `prompt`, `show info`, `prepare map`/`add map @<ver> <<`/`commit map`,
+`add map`, `set map`, `del map`, `show map`, `show table` (whole, `key <k>` and `data.<col> gt <n>`),
+`set table`, `clear table` (whole and `key <k>`), and `set/enable/disable server`. Replies are formatted like HAProxy's,
+including the `+ ` prompt that answers every line of a payload in prompt mode.
+
+Stick tables are given as {table: columns}, with the columns in the order HAProxy prints them.
+`bench tick` plays one round of traffic: a share of the users in the maps get new bytes in every table
+that counts them, which is what HAProxy does when they make requests.
+"""
+from typing import *
+import os
+import random
+import socketserver
+import threading
+
+# rows of a `show table` reply sent at once
+SEND_ROWS = 4096
+
+
+class TrafficModel:
+    """
+    `active` is the share of the users with traffic in a round, and `mean_bytes` their mean upload
+    plus download, drawn from `distribution`: 'pareto' (heavy tail, alpha 1.16), 'exp' or 'uniform'.
+    Download is `download_ratio` times the upload. Of the active users, `connected` keep a stream open.
+    """
+
+    def __init__(self, active: float = 0.1, mean_bytes: float = 50 * 1024**2, distribution: str = 'pareto',
+                 download_ratio: float = 8, connected: float = 0.2, seed: int = 0):
+        self.active = active
+        self.mean_bytes = mean_bytes
+        self.distribution = distribution
+        self.download_ratio = download_ratio
+        self.connected = connected
+        self.rng = random.Random(seed)
+
+    def draw(self) -> int:
+        if self.distribution == 'pareto':
+            alpha = 1.16
+            return int(self.rng.paretovariate(alpha) * self.mean_bytes * (alpha - 1) / alpha)
+        if self.distribution == 'exp':
+            return int(self.rng.expovariate(1 / self.mean_bytes))
+        if self.distribution == 'uniform':
+            return int(self.rng.uniform(0, 2 * self.mean_bytes))
+        raise ValueError(f'Unknown distribution: {self.distribution}')
+
+    def split(self, size: int) -> Tuple[int, int]:
+        upload = int(size / (1 + self.download_ratio))
+        return upload, size - upload
+
+
+class FakeRuntime:
+    def __init__(self, tables: Dict[str, List[str]], model: Optional[TrafficModel] = None):
+        self.columns = tables
+        self.tables: Dict[str, Dict[int, Dict[str, int]]] = {table: dict() for table in tables}
+        self.maps: Dict[str, Dict[str, str]] = dict()
+        # map -> (last version, entries of the version being prepared)
+        self.versions: Dict[str, Tuple[int, Dict[str, str]]] = dict()
+        self.model = model if model is not None else TrafficModel()
+        self.lock = threading.Lock()
+        self.n_commands = 0
+
+    def _entry(self, table: str, key: int) -> Dict[str, int]:
+        rows = self.tables.setdefault(table, dict())
+        if key not in rows:
+            rows[key] = {column: 0 for column in self.columns.get(table, [])}
+        return rows[key]
+
+    def show_table(self, args: List[str]) -> Iterator[str]:
+        table = args[0]
+        rows = self.tables.get(table, dict())
+        if len(args) == 3 and args[1] == 'key':
+            key = int(args[2])
+            selected = [(key, rows[key])] if key in rows else []
+        elif len(args) == 4 and args[1].startswith('data.') and args[2] == 'gt':
+            column, value = args[1][len('data.'):], int(args[3])
+            selected = [(key, row) for key, row in rows.items() if row.get(column, 0) > value]
+        else:
+            selected = list(rows.items())
+        yield f'# table: {table}, type: integer, size:1048576, used:{len(rows)}\n'
+        for i in range(0, len(selected), SEND_ROWS):
+            yield ''.join(
+                f'0x{0x55d7c1a30000 + key:x}: key={key} use=0 exp=0 shard=0 '
+                + ' '.join(f'{column}={value}' for column, value in row.items()) + '\n'
+                for key, row in selected[i:i + SEND_ROWS]
+            )
+
+    def set_table(self, args: List[str]) -> str:
+        # set table <table> key <key> data.<col> <value> [data.<col> <value> ...]
+        entry = self._entry(args[0], int(args[2]))
+        for i in range(3, len(args) - 1, 2):
+            entry[args[i][len('data.'):]] = int(args[i + 1])
+        return ''
+
+    def tick(self) -> str:
+        model = self.model
+        uids = {int(v) for entries in self.maps.values() for v in entries.values()}
+        n_active = 0
+        # streams of the round before are over
+        for rows in self.tables.values():
+            for row in rows.values():
+                if 'conn_cur' in row:
+                    row['conn_cur'] = 0
+        for uid in uids:
+            if model.rng.random() >= model.active:
+                continue
+            n_active += 1
+            upload, download = model.split(model.draw())
+            connected = model.rng.random() < model.connected
+            for table, columns in self.columns.items():
+                if 'bytes_in_cnt' not in columns and 'bytes_out_cnt' not in columns:
+                    continue
+                entry = self._entry(table, uid)
+                if 'bytes_in_cnt' in entry:
+                    entry['bytes_in_cnt'] += upload
+                if 'bytes_out_cnt' in entry:
+                    entry['bytes_out_cnt'] += download
+                if 'gpt0' in entry:
+                    entry['gpt0'] = 1
+                if 'conn_cur' in entry:
+                    entry['conn_cur'] = int(connected)
+        return f'{n_active} active\n'
+
+    def map_command(self, verb: str, args: List[str], payload: List[str]) -> str:
+        if verb == 'prepare':
+            version = self.versions.get(args[0], (0, None))[0] + 1
+            self.versions[args[0]] = (version, dict())
+            return f'New version created: {version}\n'
+        if verb == 'commit':
+            version, entries = self.versions.get(args[1], (0, None))
+            if entries is None or args[0] != f'@{version}':
+                return 'Unknown map version.\n'
+            self.maps[args[1]] = entries
+            self.versions[args[1]] = (version, None)
+            return ''
+        if verb == 'show':
+            return ''.join(f'0x{i:x} {k} {v}\n' for i, (k, v) in enumerate(self.maps.get(args[0], dict()).items()))
+        if verb == 'add' and args[0].startswith('@'):
+            version, entries = self.versions.get(args[1], (0, None))
+            if entries is None or args[0] != f'@{version}':
+                return 'Unknown map version.\n'
+            for line in payload:
+                k, v = line.split()
+                entries[k] = v
+            return ''
+        entries = self.maps.setdefault(args[0], dict())
+        if verb == 'del':
+            if entries.pop(args[1], None) is None:
+                return 'Key not found.\n'
+            return ''
+        if verb == 'set' and args[1] not in entries:
+            return 'entry not found.\n'
+        entries[args[1]] = args[2]
+        return ''
+
+    def handle(self, command: str, payload: List[str]) -> Iterator[str]:
+        words = command.split()
+        self.n_commands += 1
+        if not words:
+            return
+        if words[0] == 'show' and words[1:2] == ['table']:
+            yield from self.show_table(words[2:])
+        elif words[0] == 'show' and words[1:2] == ['info']:
+            yield f'Name: HAProxy\nVersion: fake\nPid: {os.getpid()}\n'
+        elif words[0] == 'set' and words[1:2] == ['table']:
+            yield self.set_table(words[2:])
+        elif words[0] == 'clear' and words[1:2] == ['table']:
+            if words[3:4] == ['key']:
+                self.tables.get(words[2], dict()).pop(int(words[4]), None)
+            else:
+                self.tables[words[2]] = dict()
+        elif words[1:2] == ['map'] and words[0] in ['prepare', 'commit', 'show', 'add', 'set', 'del']:
+            yield self.map_command(words[0], words[2:], payload)
+        elif words[1:2] == ['server'] and words[0] in ['set', 'enable', 'disable']:
+            if words[0] == 'set':
+                yield f"IP changed from '0.0.0.0' to '{words[4]}', port changed from '1' to '{words[6]}' by 'stats socket command'\n"
+        elif words == ['bench', 'tick']:
+            yield self.tick()
+        else:
+            yield 'Unknown command. Please enter one of the following commands only :\n'
+
+
+class _Handler(socketserver.StreamRequestHandler):
+    def handle(self):
+        runtime: FakeRuntime = self.server.runtime
+        prompt = False
+        while True:
+            line = self.rfile.readline()
+            if not line:
+                return
+            command = line.decode().strip()
+            payload = list()
+            if command.endswith('<<'):
+                command = command[:-2].strip()
+                for line in iter(self.rfile.readline, b''):
+                    if not line.strip():
+                        break
+                    payload.append(line.decode().strip())
+                    if prompt:
+                        # the continuation prompt of HAProxy's prompt mode
+                        self.wfile.write(b'+ ')
+            if command == 'prompt':
+                prompt = True
+                self.wfile.write(b'\n> ')
+                continue
+            with runtime.lock:
+                for piece in runtime.handle(command, payload):
+                    self.wfile.write(piece.encode())
+            if not prompt:
+                return
+            self.wfile.write(b'\n> ')
+
+
+class _UnixServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    daemon_threads = True
+
+
+def serve(path: str, tables: Dict[str, List[str]], model: Optional[TrafficModel] = None):
+    if os.path.exists(path):
+        os.unlink(path)
+    server = _UnixServer(path, _Handler)
+    server.runtime = FakeRuntime(tables, model)
+    server.serve_forever()
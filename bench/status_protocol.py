@@ -0,0 +1,73 @@
+"""
+Bytes and CPU time of status reports, `update <json>` lines vs compact frames.
+
+    python -m bench.status_protocol [--samples 3600] [--per-frame 4]
+
+Samples are made like `StatusClient.run` makes them: a few fields move every sample (cpu, rates,
+load), the rest rarely. They are encoded and decoded by the reference decoder, which checks that
+every sample comes back intact.
+"""
+import json
+import time
+import random
+from argparse import ArgumentParser
+
+from status_protocol import CompactEncoder, CompactDecoder
+
+
+def make_samples(n):
+    sample = {
+        'uptime': 100000, 'load_1': 0.5, 'load_5': 0.4, 'load_15': 0.3, 'memory_total': 2035632,
+        'memory_used': 612340, 'swap_total': 0, 'swap_used': 0, 'hdd_total': 40000, 'hdd_used': 12000,
+        'cpu': 12.5, 'network_rx': 0, 'network_tx': 0, 'network_in': 123456789, 'network_out': 987654321,
+        'ip_status': True, 'tcp': 120, 'udp': 1500, 'process': 130, 'thread': 400,
+    }
+    for mark in ['10010', '189', '10086', 'edu']:
+        sample.update({f'ping_{mark}': 0.0, f'time_{mark}': 30, f'time_{mark}_p50': 30,
+                       f'time_{mark}_p95': 45, f'time_{mark}_p99': 60})
+    samples = list()
+    for i in range(n):
+        sample = dict(sample)
+        sample['uptime'] += 1
+        sample['cpu'] = round(random.uniform(5, 30), 1)
+        sample['network_rx'] = random.randint(10**5, 10**7)
+        sample['network_tx'] = random.randint(10**5, 10**7)
+        sample['udp'] = 1500 + random.randint(-20, 20)
+        if i % 5 == 0:
+            sample['load_1'] = round(random.uniform(0, 2), 2)
+            sample['memory_used'] += random.randint(-1000, 1000)
+        if i % 60 == 0:
+            sample['network_in'] += random.randint(10**6, 10**8)
+            sample['network_out'] += random.randint(10**6, 10**8)
+            sample['time_10010'] = random.randint(20, 60)
+        samples.append(sample)
+    return samples
+
+
+def main():
+    parser = ArgumentParser()
+    parser.add_argument('--samples', type=int, default=3600)
+    parser.add_argument('--per-frame', type=int, default=4)
+    args = parser.parse_args()
+    samples = make_samples(args.samples)
+
+    since = time.process_time()
+    lines = ['update ' + json.dumps(sample) + '\n' for sample in samples]
+    full_cpu = time.process_time() - since
+    full_bytes = sum(map(len, lines))
+
+    for per_frame in sorted({1, args.per_frame}):
+        encoder, decoder = CompactEncoder(), CompactDecoder()
+        since = time.process_time()
+        frames = [encoder.encode(samples[i:i + per_frame]) for i in range(0, len(samples), per_frame)]
+        cpu = time.process_time() - since
+        decoded = [sample for frame in frames for sample in decoder.decode(frame)]
+        assert decoded == samples
+        print(f'compact x{per_frame}: {sum(map(len, frames)) / len(samples):7.1f} bytes, '
+              f'{cpu / len(samples) * 1e6:6.1f}us per sample, {len(frames)} lines')
+    print(f'  update: {full_bytes / len(samples):7.1f} bytes, {full_cpu / len(samples) * 1e6:6.1f}us per sample, '
+          f'{len(lines)} lines')
+
+
+if __name__ == '__main__':
+    main()
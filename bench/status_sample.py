@@ -0,0 +1,66 @@
+"""
+CPU time per status sample, the `ss`/`ps`/`df`/`vnstat` pipelines vs reading /proc.
+
+    python -m bench.status_sample [--samples 50]
+
+A sample is what `StatusClient.run` collects besides CPU, memory and probes: socket, process and
+thread counts, disk usage, and the vnstat traffic. CPU time includes the spawned processes.
+"""
+import os
+import json
+import time
+import subprocess
+from argparse import ArgumentParser
+
+from status import StatusClient
+
+
+def legacy_sample():
+    u = int(subprocess.check_output("ss -nt|wc -l", shell=True)[:-1]) - 1
+    u += int(subprocess.check_output("ss -nu|wc -l", shell=True)[:-1]) - 1
+    p = int(subprocess.check_output("ps -ef|wc -l", shell=True)[:-1]) - 2
+    d = int(subprocess.check_output("ps -eLf|wc -l", shell=True)[:-1]) - 2
+    try:
+        total = subprocess.check_output(['df', '-Tlm', '--total', '-t', 'ext4', '-t', 'xfs', '-t', 'btrfs']).decode().splitlines()[-1]
+        size, used = int(total.split()[2]), int(total.split()[3])
+    except subprocess.CalledProcessError:
+        size = used = 0
+    try:
+        json.loads(subprocess.getoutput('vnstat --json'))
+    except ValueError:
+        pass
+    return u, p, d, size, used
+
+
+def proc_sample(client):
+    tcp, udp = client.count_sockets()
+    p, d = client.count_tasks()
+    size, used = client.get_hdd()
+    # vnstat is cached; the cached value is what almost every sample gets
+    return tcp + udp, p, d, size, used, client.vnstat_cache[1]
+
+
+def measure(func, n):
+    since, wall_since = os.times(), time.time()
+    for _ in range(n):
+        ret = func()
+    until = os.times()
+    cpu = sum(until[:4]) - sum(since[:4])
+    return cpu / n, (time.time() - wall_since) / n, ret
+
+
+def main():
+    parser = ArgumentParser()
+    parser.add_argument('--samples', type=int, default=50)
+    args = parser.parse_args()
+
+    # the collectors touch no state set up by __init__ besides the vnstat cache
+    client = StatusClient.__new__(StatusClient)
+    client.vnstat_cache = [time.time(), (0, 0)]
+    for name, func in [('legacy', legacy_sample), ('proc', lambda: proc_sample(client))]:
+        cpu, wall, ret = measure(func, args.samples)
+        print(f'{name:>8}: {cpu * 1000:8.3f}ms CPU, {wall * 1000:8.3f}ms wall per sample. Last: {ret}')
+
+
+if __name__ == '__main__':
+    main()
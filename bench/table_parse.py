@@ -0,0 +1,75 @@
+"""
+Compare the `show table` parsers used by `HAProxy.fetch_traffic`.
+
+    python -m bench.table_parse [--sizes 10000 100000 1000000]
+
+`regex` is the old path: join every piece, decode, and `re.findall` over the whole text.
+`stream` is `port.runtime.parse_table` fed with the same pieces as they come off the socket.
+"""
+from typing import *
+import re
+import time
+import tracemalloc
+from argparse import ArgumentParser
+
+from port.runtime import parse_table
+
+RECV_SIZE = 256 * 1024
+
+
+def make_dump(n: int) -> List[bytes]:
+    lines = [f'# table: st_in, type: integer, size:1048576, used:{n}\n'.encode()]
+    lines.extend(
+        f'0x55d7c1a3{i:06x}: key={i + 1} use=0 exp=0 shard=0 bytes_in_cnt={i * 7919 % 10**9}\n'.encode()
+        for i in range(n)
+    )
+    data = b''.join(lines)
+    return [data[i:i + RECV_SIZE] for i in range(0, len(data), RECV_SIZE)]
+
+
+def regex_path(pieces: List[bytes]) -> int:
+    pat = re.compile(r'key=(\d*) use.*?cnt=(\d*)')
+    total = 0
+    table = b''.join(pieces).decode()
+    for uid, size in pat.findall(table):
+        total += int(size)
+    return total
+
+
+def stream_path(pieces: List[bytes]) -> int:
+    total = 0
+    for uid, size in parse_table(iter(pieces), ['bytes_in_cnt']):
+        total += size
+    return total
+
+
+def measure(func, pieces):
+    tracemalloc.start()
+    since = time.perf_counter()
+    result = func(pieces)
+    cost = time.perf_counter() - since
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    # timing without tracemalloc, which slows allocations down
+    since = time.perf_counter()
+    func(pieces)
+    return result, min(cost, time.perf_counter() - since), peak
+
+
+def main():
+    parser = ArgumentParser()
+    parser.add_argument('--sizes', type=int, nargs='+', default=[10**4, 10**5, 10**6])
+    args = parser.parse_args()
+    print(f'{"entries":>10} {"parser":>8} {"time/s":>8} {"peak/MiB":>9}')
+    for n in args.sizes:
+        pieces = make_dump(n)
+        results = set()
+        for name, func in [('regex', regex_path), ('stream', stream_path)]:
+            result, cost, peak = measure(func, pieces)
+            results.add(result)
+            print(f'{n:>10} {name:>8} {cost:>8.3f} {peak / 1024**2:>9.1f}')
+        assert len(results) == 1, 'parsers disagree'
+
+
+if __name__ == '__main__':
+    main()
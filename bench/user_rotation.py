@@ -0,0 +1,63 @@
+"""
+Cost of a mass key rotation in `PortBase.diff_user_config`.
+
+    python -m bench.user_rotation [--users 50000]
+
+`deepcopy` is the old path, which cloned every altered Account (with its lists) to remember its old uuid.
+`rekey` is `Account.rekey`, which only keeps the old map key.
+Both include computing the keys to remove from the map.
+"""
+import time
+from copy import deepcopy
+from argparse import ArgumentParser
+
+from port.account import Account, sha1_map_key
+from port.account_store import AccountStore
+from bench.account_store import LegacyAccount
+
+
+class BenchUser:
+    def __init__(self, user_id, uuid):
+        self.user_id = user_id
+        self.uuid = uuid
+        self.email = f'user{user_id}@example.com'
+        self.balance = 10 * 1024**3
+        self.tag = 'default'
+
+
+def old_path(accounts, users):
+    del_users = list()
+    for a, u in zip(accounts, users):
+        del_users.append(deepcopy(a))
+        a.user = u
+    return [sha1_map_key(a.user.uuid) for a in del_users]
+
+
+def new_path(accounts, users):
+    del_users = list()
+    for a, u in zip(accounts, users):
+        a.rekey(u)
+        del_users.append(a)
+    removed = [a.prev_map_key for a in del_users]
+    for a in del_users:
+        a.prev_map_key = None
+    return removed
+
+
+def main():
+    parser = ArgumentParser()
+    parser.add_argument('--users', type=int, default=50000)
+    args = parser.parse_args()
+    store = AccountStore()
+    for name, func, make in [('deepcopy', old_path, LegacyAccount), ('rekey', new_path, lambda u: Account(u, store))]:
+        accounts = [make(BenchUser(i, f'old-{i}')) for i in range(args.users)]
+        users = [BenchUser(i, f'new-{i}') for i in range(args.users)]
+        since = time.perf_counter()
+        removed = func(accounts, users)
+        cost = time.perf_counter() - since
+        assert removed[0] == sha1_map_key('old-0')
+        print(f'{name:>8}: {args.users} users rotated in {cost:.3f}s')
+
+
+if __name__ == '__main__':
+    main()
@@ -1,33 +1,78 @@
+from typing import *
+import base64
+import hashlib
+
 from walless_utils import User
 
+from .account_store import AccountStore
+
+
+def sha1_map_key(uuid) -> str:
+    # HAProxy looks users up by the sha1 of their Proxy-Authorization header
+    return hashlib.sha1(b'Basic ' + base64.b64encode(f'walless:{uuid}'.encode())).hexdigest().upper()
+
 
 class Account:
-    # Lower bound: 100 kiB. Default threshold: 1 MiB.
-    SENSITIVITY_LOWER_BOUND = 100 * 1024**1
-    SENSITIVITY = 1 * 1024**2
+    """
+    A user on this node. Its traffic counters live in a row of an AccountStore, which is shared by
+    all accounts of a PortBase; an account created without a store gets a store of its own.
+    """
+    __slots__ = ['_user', 'map_key', 'prev_map_key', 'store', 'row']
+    SENSITIVITY_LOWER_BOUND = AccountStore.SENSITIVITY_LOWER_BOUND
+    SENSITIVITY = AccountStore.SENSITIVITY
+
+    def __init__(self, user, store: Optional[AccountStore] = None, map_key: Optional[str] = None):
+        self._user: Optional[User] = None
+        # sha1 of the user's Proxy-Authorization, i.e., its key in the user map.
+        # Computed when the user is set and recomputed only if the uuid changes; a known key may be given.
+        self.map_key: str = ''
+        if map_key is not None:
+            self._user, self.map_key = user, map_key
+        else:
+            self.user = user
+        # map key of the uuid before the last change, kept until the old entry is removed from the map
+        self.prev_map_key: Optional[str] = None
+        self.store = store if store is not None else AccountStore(capacity=1)
+        self.row = self.store.allocate(user.user_id)
+
+    @property
+    def user(self) -> User:
+        return self._user
 
-    def __init__(self, user):
-        self.user: User = user
+    @user.setter
+    def user(self, user: User):
+        if self._user is None or self._user.uuid != user.uuid:
+            self.map_key = sha1_map_key(user.uuid)
+        self._user = user
+
+    def rekey(self, user: User):
+        # the uuid of this user changed
+        self.prev_map_key = self.map_key
+        self.user = user
+
+    def release(self):
+        # the account is removed; its row will be reused
+        self.store.release(self.row)
+        self.row = -1
+
+    @property
+    def traffic(self) -> List[int]:
         # upload, download
-        self.traffic = [0, 0]
-        self.last_traffic = [0, 0]
-        self.threshold = self.SENSITIVITY
+        return [int(self.store.up[self.row]), int(self.store.down[self.row])]
+
+    @property
+    def last_traffic(self) -> List[int]:
+        return [int(self.store.last_up[self.row]), int(self.store.last_down[self.row])]
+
+    @property
+    def threshold(self) -> int:
+        return int(self.store.threshold[self.row])
 
     def update_traffic(self, upload=None, download=None) -> bool:
-        changed = False
-        if upload is not None:
-            if upload > self.traffic[0]:
-                changed = True
-            self.traffic[0] = max(upload, self.traffic[0])
-        if download is not None:
-            if download > self.traffic[1]:
-                changed = True
-            self.traffic[1] = max(download, self.traffic[1])
-        return changed
+        return self.store.update(self.row, upload, download)
 
     def reset(self):
-        self.last_traffic = self.traffic.copy()
-        self.threshold = self.SENSITIVITY
+        self.store.reset([self.row])
 
     def diff(self):
         return [self.traffic[i] - self.last_traffic[i] for i in range(2)]
@@ -37,7 +82,7 @@ class Account:
         # Otherwise, lower the threshold by half. The minimum threshold is SENSITIVITY_LOWER_BOUND.
         if sum(self.diff()) >= self.threshold:
             return True
-        self.threshold = max(self.SENSITIVITY_LOWER_BOUND, self.threshold // 2)
+        self.store.threshold[self.row] = max(self.SENSITIVITY_LOWER_BOUND, self.threshold // 2)
         return False
 
     def __repr__(self):
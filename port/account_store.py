@@ -0,0 +1,151 @@
+from typing import *
+from array import array
+
+try:
+    import numpy as np
+except ImportError:
+    # the array module gives the same compact layout, but the bulk operations loop in Python
+    np = None
+
+
+class AccountStore:
+    """
+    Traffic counters of all accounts, in columns of int64 with one row per account:
+    user id, current upload/download, last reported upload/download, and report threshold.
+    Rows of removed accounts are zeroed and reused. The per-round work (`collect` and `reset`)
+    runs over whole columns at once.
+    """
+    # Lower bound: 100 kiB. Default threshold: 1 MiB.
+    SENSITIVITY_LOWER_BOUND = 100 * 1024**1
+    SENSITIVITY = 1 * 1024**2
+    COLUMNS = ['uid', 'up', 'down', 'last_up', 'last_down', 'threshold']
+
+    def __init__(self, capacity: int = 1024):
+        self.capacity = 0
+        # rows below n_rows have been handed out at least once
+        self.n_rows = 0
+        self.free: List[int] = list()
+        for col in self.COLUMNS:
+            setattr(self, col, self._zeros(0))
+        self._grow(max(capacity, 1))
+
+    @staticmethod
+    def _zeros(n: int):
+        if np is not None:
+            return np.zeros(n, dtype=np.int64)
+        return array('q', bytes(8 * n))
+
+    def _grow(self, capacity: int):
+        for col in self.COLUMNS:
+            old = getattr(self, col)
+            new = self._zeros(capacity)
+            new[:len(old)] = old
+            setattr(self, col, new)
+        self.capacity = capacity
+
+    def __len__(self):
+        return self.n_rows - len(self.free)
+
+    def allocate(self, uid: int) -> int:
+        if self.free:
+            row = self.free.pop()
+        else:
+            if self.n_rows == self.capacity:
+                self._grow(self.capacity * 2)
+            row = self.n_rows
+            self.n_rows += 1
+        self.uid[row] = uid
+        self.threshold[row] = self.SENSITIVITY
+        return row
+
+    def release(self, row: int):
+        for col in self.COLUMNS:
+            getattr(self, col)[row] = 0
+        self.free.append(row)
+
+    def update(self, row: int, upload: Optional[int] = None, download: Optional[int] = None) -> bool:
+        changed = False
+        if upload is not None and upload > self.up[row]:
+            self.up[row] = upload
+            changed = True
+        if download is not None and download > self.down[row]:
+            self.down[row] = download
+            changed = True
+        return changed
+
+    def update_many(self, col: str, rows: List[int], values: List[int]):
+        # counters only go up: keep the max of the stored and the new values
+        column = getattr(self, col)
+        if np is not None:
+            np.maximum.at(column, np.asarray(rows, dtype=np.int64), np.asarray(values, dtype=np.int64))
+            return
+        for row, value in zip(rows, values):
+            if value > column[row]:
+                column[row] = value
+
+    def collect(self, active_threshold: int) -> Tuple[List[int], List[int], List[int], List[int], int, int]:
+        """
+        Pick the rows to report, like Account.need_report does for one account: rows whose
+        traffic since the last report reaches their threshold; the thresholds of the other rows
+        with new traffic are halved down to SENSITIVITY_LOWER_BOUND.
+        Returns rows, user ids, upload and download deltas of the picked rows, the number of rows
+        with new traffic, and the number of picked rows above `active_threshold`.
+        """
+        n = self.n_rows
+        if np is not None:
+            du = self.up[:n] - self.last_up[:n]
+            dd = self.down[:n] - self.last_down[:n]
+            total = du + dd
+            changed = total != 0
+            report = changed & (total >= self.threshold[:n])
+            halve = changed & ~report
+            threshold = self.threshold[:n]
+            threshold[halve] = np.maximum(threshold[halve] // 2, self.SENSITIVITY_LOWER_BOUND)
+            rows = np.flatnonzero(report)
+            n_active = int((total[rows] > active_threshold).sum())
+            return (rows.tolist(), self.uid[rows].tolist(), du[rows].tolist(), dd[rows].tolist(),
+                    int(changed.sum()), n_active)
+
+        rows, uids, u_deltas, d_deltas = list(), list(), list(), list()
+        n_total = n_active = 0
+        for row in range(n):
+            du, dd = self.up[row] - self.last_up[row], self.down[row] - self.last_down[row]
+            if du + dd == 0:
+                continue
+            n_total += 1
+            if du + dd < self.threshold[row]:
+                self.threshold[row] = max(self.SENSITIVITY_LOWER_BOUND, self.threshold[row] // 2)
+                continue
+            rows.append(row)
+            uids.append(self.uid[row])
+            u_deltas.append(du)
+            d_deltas.append(dd)
+            if du + dd > active_threshold:
+                n_active += 1
+        return rows, uids, u_deltas, d_deltas, n_total, n_active
+
+    def rebase(self, col: str):
+        # the counters of `col` ('up' or 'down') start over from zero, e.g., after the traffic table is
+        # reset; the traffic not reported yet is kept by moving the last reported values below zero
+        column, last = getattr(self, col), getattr(self, f'last_{col}')
+        n = self.n_rows
+        if np is not None:
+            last[:n] -= column[:n]
+            column[:n] = 0
+            return
+        for row in range(n):
+            last[row] -= column[row]
+            column[row] = 0
+
+    def reset(self, rows: List[int]):
+        # the traffic of these rows is reported
+        if np is not None:
+            rows = np.asarray(rows, dtype=np.int64)
+            self.last_up[rows] = self.up[rows]
+            self.last_down[rows] = self.down[rows]
+            self.threshold[rows] = self.SENSITIVITY
+            return
+        for row in rows:
+            self.last_up[row] = self.up[row]
+            self.last_down[row] = self.down[row]
+            self.threshold[row] = self.SENSITIVITY
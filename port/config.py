@@ -0,0 +1,159 @@
+from typing import *
+import hashlib
+import ipaddress
+from dataclasses import dataclass, field
+
+INDENT = '    '
+
+
+@dataclass()
+class Server:
+    name: str
+    # host:port
+    address: str
+    options: str = ''
+
+    @property
+    def host(self) -> str:
+        return self.address.rsplit(':', 1)[0].strip('[]')
+
+    @property
+    def port(self) -> str:
+        return self.address.rsplit(':', 1)[1] if ':' in self.address else ''
+
+    def render(self) -> str:
+        return ' '.join(filter(None, ['server', self.name, self.address, self.options]))
+
+    @classmethod
+    def parse(cls, line: str) -> 'Server':
+        fields = line.split(maxsplit=3)
+        return cls(fields[1], fields[2], fields[3] if len(fields) > 3 else '')
+
+
+@dataclass()
+class Section:
+    """
+    A section of an HAProxy config: `kind` (global, defaults, resolvers, peers, backend, frontend, listen)
+    and `name`, its bind and server lines, and the other lines of its body in order.
+    """
+    kind: str
+    name: str = ''
+    binds: List[str] = field(default_factory=list)
+    lines: List[str] = field(default_factory=list)
+    servers: List[Server] = field(default_factory=list)
+
+    @property
+    def key(self) -> str:
+        return f'{self.kind} {self.name}'.strip()
+
+    def render(self) -> str:
+        body = [f'bind {bind}' for bind in self.binds] + self.lines + [server.render() for server in self.servers]
+        # no blank lines at the end of the section
+        while body and not body[-1]:
+            body.pop()
+        return '\n'.join([self.key] + [INDENT + line if line else '' for line in body]) + '\n'
+
+    def add_line(self, line: str):
+        if line.startswith('bind '):
+            self.binds.append(line[len('bind '):])
+        elif line.startswith('server '):
+            self.servers.append(Server.parse(line))
+        else:
+            self.lines.append(line)
+
+
+def relay_section(relay_id: int, port_start: int, port_end: int, n_slots: int = 2) -> Section:
+    # listens on ports [port_start, port_end); the target is set into the server slots at runtime.
+    # The slots have a fixed port: with port 0, HAProxy would map the port of the client instead,
+    # and refuse to set one.
+    return Section(
+        'listen', f'relay{relay_id}',
+        binds=[f'*:{port_start}-{port_end - 1}', f':::{port_start}-{port_end - 1}'],
+        lines=['mode tcp'],
+        servers=[Server(f'slot{slot}', '0.0.0.0:1', 'disabled') for slot in range(n_slots)],
+    )
+
+
+class ConfigChange(NamedTuple):
+    # 'none', 'runtime' (server addresses only, which the runtime API can change) or 'reload'
+    kind: str
+    # (section name, server) of the servers to update, for a 'runtime' change
+    servers: List[Tuple[str, Server]]
+
+
+class HAProxyConfig:
+    """
+    An HAProxy config as an ordered list of sections, which renders the same text for the same content.
+    `parse` reads the config literals of this package; sections are replaced or added by their key.
+    `diff` tells what it takes to go from another config to this one.
+    """
+
+    def __init__(self, sections: Iterable[Section] = ()):
+        self.sections: Dict[str, Section] = {section.key: section for section in sections}
+
+    @classmethod
+    def parse(cls, text: str) -> 'HAProxyConfig':
+        sections, section = list(), None
+        for line in text.splitlines():
+            if not line.strip():
+                if section is not None:
+                    section.lines.append('')
+                continue
+            if line[0].isspace():
+                section.add_line(line.strip())
+            else:
+                kind, _, name = line.strip().partition(' ')
+                section = Section(kind, name.strip())
+                sections.append(section)
+        for section in sections:
+            # blank lines before the first line of the body are dropped as well
+            while section.lines and not section.lines[0]:
+                section.lines.pop(0)
+        return cls(sections)
+
+    def __getitem__(self, key: str) -> Section:
+        return self.sections[key]
+
+    def __contains__(self, key: str) -> bool:
+        return key in self.sections
+
+    def put(self, section: Section):
+        # replaces the section with the same key in place, or appends it
+        self.sections[section.key] = section
+
+    def remove(self, key: str):
+        self.sections.pop(key, None)
+
+    def render(self) -> str:
+        return '\n'.join(section.render() for section in self.sections.values())
+
+    def digest(self) -> str:
+        return hashlib.sha1(self.render().encode()).hexdigest()
+
+    def diff(self, old: Optional['HAProxyConfig']) -> ConfigChange:
+        # Servers whose address moves to another IP can be changed by the runtime API.
+        # Anything else (sections, binds, other lines, server names and options, host names) needs a reload.
+        if old is None or list(old.sections) != list(self.sections):
+            return ConfigChange('reload', [])
+        servers = list()
+        for key, section in self.sections.items():
+            old_section = old.sections[key]
+            if (section.binds, section.lines) != (old_section.binds, old_section.lines):
+                return ConfigChange('reload', [])
+            if [(s.name, s.options) for s in section.servers] != [(s.name, s.options) for s in old_section.servers]:
+                return ConfigChange('reload', [])
+            for server, old_server in zip(section.servers, old_section.servers):
+                if server.address == old_server.address:
+                    continue
+                if not is_ip(server.host):
+                    return ConfigChange('reload', [])
+                servers.append((section.name, server))
+        return ConfigChange('runtime' if servers else 'none', servers)
+
+
+def is_ip(host: str) -> bool:
+    try:
+        ipaddress.ip_address(host)
+        return True
+    except ValueError:
+        return False
@@ -2,15 +2,27 @@ from typing import *
 import os
 from dataclasses import dataclass, field
 import time
+import random
+import asyncio
 import traceback
 from threading import Thread
 import logging
 
 from .utils import restart
+from .metrics import Histogram, Counter, REGISTRY
 
 logger = logging.getLogger('walless')
 
 
+def cron_counter(name: str, job: str) -> Counter:
+    # runs, errors or timeouts of a job
+    return REGISTRY.counter(f'walless_cron_{name}_total', f'Cron job {name}', job=job)
+
+
+def cron_timing(job: str, histogram: Optional[Histogram] = None) -> Histogram:
+    return REGISTRY.register('walless_cron_seconds', histogram or Histogram(), 'Time of cron job runs', job=job)
+
+
 @dataclass()
 class CronJob:
     """
@@ -40,9 +52,11 @@ class CronJob:
     def job_wrapper(self):
         self._no_exception = self._is_checked = False
         self._last_start = time.time()
+        cron_counter('runs', self.name).inc()
         self.func_to_call(*self.args, **self.kwargs)
         self._no_exception = True
         self._running_time = time.time() - self._last_start
+        cron_timing(self.name).observe(self._running_time)
 
     def _execute(self):
         self._job_thread = Thread(target=self.job_wrapper, daemon=True)
@@ -53,6 +67,7 @@ class CronJob:
             return
         if self._job_thread.is_alive():
             if time.time() - self._last_start > self.timeout:
+                cron_counter('timeouts', self.name).inc()
                 if self.exit_when_timeout:
                     restart()
                 else:
@@ -60,6 +75,8 @@ class CronJob:
         elif not self._is_checked:
             # after execution and before check
             self._is_checked = True
+            if not self._no_exception:
+                cron_counter('errors', self.name).inc()
             if not self._no_exception and self.in_error is not None:
                 self.in_error()
 
@@ -101,3 +118,113 @@ class CronManager:
         except Exception as e:
             logger.error(f'Error! Loop stopped. {e}')
             logger.error(traceback.format_exc())
+
+
+@dataclass()
+class AsyncCronJob:
+    """
+    A job run by AsyncCronManager every `interval` seconds, plus a random delay of up to `jitter` seconds.
+    Coroutine functions are awaited and cancelled when they exceed `timeout`.
+    Plain functions run on the event loop's worker threads, which are reused across runs. A thread cannot be
+    cancelled, so after a timeout the job is skipped until the stuck call returns. If it is still running at
+    twice the timeout, the node is restarted like CronManager does, unless `exit_when_timeout` is False.
+    """
+    name: str
+    func_to_call: Callable
+    interval: float  # in second
+    timeout: float  # in second
+    args: List[Any] = field(default_factory=list)
+    kwargs: Dict[str, Any] = field(default_factory=dict)
+    jitter: float = 0.
+    skip_first: bool = False
+    in_error: Callable = None
+    exit_when_timeout: bool = True
+    timing: Histogram = field(default_factory=Histogram)
+    n_runs: int = 0
+    n_errors: int = 0
+    n_timeouts: int = 0
+    _pending: Optional[asyncio.Future] = None
+
+    async def run(self):
+        if self._pending is not None and not self._pending.done():
+            logger.warning(f'{self.name} is still stuck since its last timeout. Skip execution.')
+            return
+        self.n_runs += 1
+        cron_counter('runs', self.name).inc()
+        since = time.time()
+        if asyncio.iscoroutinefunction(self.func_to_call):
+            self._pending = asyncio.ensure_future(self.func_to_call(*self.args, **self.kwargs))
+            awaitable = self._pending
+        else:
+            self._pending = asyncio.get_running_loop().run_in_executor(
+                None, lambda: self.func_to_call(*self.args, **self.kwargs))
+            # keep the future alive after a timeout so that we know when the thread is free again
+            awaitable = asyncio.shield(self._pending)
+        try:
+            await asyncio.wait_for(awaitable, self.timeout)
+        except asyncio.TimeoutError:
+            self.n_timeouts += 1
+            cron_counter('timeouts', self.name).inc()
+            logger.warning(f'{self.name} timeout after {self.timeout}s!')
+            self.in_error is not None and self.in_error()
+            if self.exit_when_timeout and not self._pending.done():
+                # give the stuck thread another timeout before giving up on it
+                try:
+                    await asyncio.wait_for(asyncio.shield(self._pending), self.timeout)
+                except asyncio.TimeoutError:
+                    logger.error(f'{self.name} is still stuck after {2 * self.timeout}s.')
+                    restart()
+                except Exception as e:
+                    logger.error(f'Error in {self.name} after its timeout: {e}')
+        except Exception as e:
+            self.n_errors += 1
+            cron_counter('errors', self.name).inc()
+            logger.error(f'Error in {self.name}: {e}')
+            logger.error(traceback.format_exc())
+            self.in_error is not None and self.in_error()
+        finally:
+            self.timing.observe(time.time() - since)
+
+
+class AsyncCronManager:
+    """
+    An asyncio counterpart of CronManager. Every job keeps its own schedule in seconds, so sub-minute
+    intervals are possible, and a run that overruns its interval skips the ticks it missed.
+    """
+    def __init__(self, report_gap: float = 600):
+        self.jobs: Dict[str, AsyncCronJob] = dict()
+        # how often the timing of all jobs is logged
+        self.report_gap = report_gap
+
+    def new_job(self, job: AsyncCronJob):
+        # the timing is the one in the metrics registry
+        job.timing = cron_timing(job.name, job.timing)
+        self.jobs[job.name] = job
+
+    @staticmethod
+    async def _job_loop(job: AsyncCronJob):
+        loop = asyncio.get_running_loop()
+        start_time = loop.time()
+        tick = 1 if job.skip_first else 0
+        while True:
+            due = start_time + tick * job.interval + random.uniform(0, job.jitter)
+            await asyncio.sleep(max(due - loop.time(), 0))
+            logger.debug(f'Running {job.name}.')
+            await job.run()
+            tick = max(tick + 1, int((loop.time() - start_time) // job.interval) + 1)
+
+    async def _report_loop(self):
+        while True:
+            await asyncio.sleep(self.report_gap)
+            for name, job in self.jobs.items():
+                logger.info(f'{name}: {job.n_runs} runs, {job.n_errors} errors, {job.n_timeouts} timeouts. {job.timing}.')
+
+    async def main(self):
+        await asyncio.gather(self._report_loop(), *[self._job_loop(job) for job in self.jobs.values()])
+
+    def run(self):
+        try:
+            asyncio.run(self.main())
+        except Exception as e:
+            logger.error(f'Error! Loop stopped. {e}')
+            logger.error(traceback.format_exc())
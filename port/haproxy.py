@@ -1,134 +1,483 @@
+from typing import *
 import os
-import socket
-import re
-import base64
-import hashlib
+import time
 from subprocess import check_output
-import subprocess
 import logging
 
 from walless_utils import User
 
 from .port_base import PortBase, Account
-from .utils import haproxy_executable
+from .account import sha1_map_key
+from .runtime import RuntimeAPI, parse_table, set_server_error
+from .mapsync import MapSync
+from .config import HAProxyConfig, ConfigChange, Server, relay_section
+from .relays import RelayReconciler
+from .process import HAProxyProcess
+from .utils import haproxy_executable, report_error
 
 logger = logging.getLogger('walless')
 
 
 class HAProxy(PortBase):
-    def __init__(self, node_obj, network_status):
-        super().__init__(node_obj, network_status)
+    # an entry that is always kept in the user map
+    placeholder = ('/9192631770', 198964)
+    # key of the entry in each traffic table whose first counter holds the epoch of the table
+    epoch_key = 2147483647
+
+    def __init__(self, node_obj, network_status, pull_users: Optional[Callable] = None,
+                 pull_node: Optional[Callable] = None):
+        super().__init__(node_obj, network_status, pull_users, pull_node)
+        self.runtime = RuntimeAPI('/tmp/haproxy.sock')
+        # HAProxy starts with the users of the snapshot, if any, and serves them right away
+        accounts = self.restore_snapshot()
         with open('/tmp/usermap', 'w') as fp:
-            fp.write('/9192631770 198964')
+            fp.write(f'{self.placeholder[0]} {self.placeholder[1]}\n')
+            fp.writelines(f'{account.map_key} {account.user.user_id}\n' for account in accounts)
+        self.map_sync = MapSync(self.runtime, '/tmp/usermap')
+        self.stopped = False
+        self.tables_migrated = False
+        # users whose counters were added onto st_traffic by a migration that did not finish
+        self.moved_uids: Set[int] = set()
+        # delta fetch: read the whole table once every `full_fetch_gap` rounds
+        self.full_fetch_gap = 15
+        self.n_fetch_rounds = 0
+        self.active_uids: Set[int] = set()
+        # traffic tables the current epoch could not be written into
+        self.unwritten_epochs: Set[str] = set()
+        # the config HAProxy runs with
+        self.haproxy_config: Optional[HAProxyConfig] = None
+        self.relays = RelayReconciler(self.runtime)
 
         self.dump_haproxy_cfg()
         env = None
         # force IvyBridge-v2 CPU feature
         if 'aes' not in check_output('lscpu').decode():
             env = {'OPENSSL_ia32cap': '0xffb82203078bffff'}
-        subprocess.Popen([haproxy_executable, '-f', './haproxy_config'], env=env)
+        self.process = HAProxyProcess(haproxy_executable, self.runtime, './haproxy_config', env=env)
+        # the relay slots start disabled, and are pointed at their targets once HAProxy answers
+        if self.process.start():
+            self.reconcile_relays()
         logger.warning('Listening for incoming http connection.')
 
-    def dump_haproxy_cfg(self):
+    def build_haproxy_cfg(self) -> HAProxyConfig:
         # if the node has IPv6, then do not include `,ipv4`
-        ha_cfg = haproxy_cfg
         self.network_status.wait_for_checkups()
         self.network_status.ipv6 is not None and os.system('ip -6 route add default dev wgcf metric 99999')
-        ha_cfg = ha_cfg.replace('$IP$', ',ipv4' if self.network_status.ipv6 is None else '')
+        tables, track = traffic_table_cfg[self.table_mode]
+        if self.delta_fetch:
+            # gpt0 marks an entry as dirty on every request; conn_cur tells which entries have running streams
+            tables = tables.replace('store bytes_in_cnt,bytes_out_cnt', 'store gpt0,conn_cur,bytes_in_cnt,bytes_out_cnt')
+            track += '\n    http-request sc-set-gpt0(0) 1'
+
+        def fill(ha_cfg: str) -> HAProxyConfig:
+            ha_cfg = ha_cfg.replace('$IP$', ',ipv4' if self.network_status.ipv6 is None else '')
+            ha_cfg = ha_cfg.replace('$TRAFFIC_TABLES$', tables).replace('$TRACK_TRAFFIC$', track)
+            return HAProxyConfig.parse(ha_cfg.replace('WALLESS_ROOT', self.root))
+
+        cfg = fill(haproxy_cfg)
+        if 'gre' in self.node_obj.properties:
+            # the proxy and the frontend are replaced by their GRE versions, and the GRE sections added
+            for section in fill(gre_suffix).sections.values():
+                cfg.put(section)
         for relay in self.node_obj.relay_out:
-            logger.warning(f'Add {relay}')
+            # only the ports are in the config; targets are set by `reconcile_relays`
             port_start, port_end = relay.port_range()
+            cfg.put(relay_section(relay.relay_id, port_start, port_end, self.relays.n_slots))
+        return cfg
+
+    def relay_targets(self) -> Dict[str, Tuple[str, int]]:
+        # relay backend -> (host, port) it forwards to
+        targets = dict()
+        for relay in self.node_obj.relay_out:
             if relay.tunnel is None or len(relay.tunnel) == 0:
                 relay_tunnel = f'{relay.target.real_urls(4)}:4430'
             else:
                 relay_tunnel = relay.tunnel
-            relay_cfg = f'''\
-listen relay{relay.relay_id}
-    mode tcp
-    bind *:{port_start}-{port_end-1}
-    bind :::{port_start}-{port_end-1}
-    server relay{relay.relay_id}backend {relay_tunnel}
-            '''
-            ha_cfg += '\n' + relay_cfg + '\n'
-        if 'gre' in self.node_obj.properties:
-            ha_cfg = ha_cfg[:ha_cfg.index('listen proxy')] + gre_suffix
-        ha_cfg = ha_cfg.replace('WALLESS_ROOT', self.root)
-        with open('haproxy_config/haproxy.cfg', 'w') as fp:
-            fp.write(ha_cfg)
+            host, port = relay_tunnel.rsplit(':', 1)
+            targets[f'relay{relay.relay_id}'] = (host.strip('[]'), int(port))
+        return targets
 
-    @staticmethod
-    def talk(msg, need_return):
-        s = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
-        s.connect('/tmp/haproxy.sock')
-        s.send(msg.encode() if msg.endswith('\n') else (msg + '\n').encode())
+    def reconcile_relays(self):
+        try:
+            self.relays.reconcile(self.relay_targets())
+        except Exception as e:
+            logger.error(f'Exception while updating relays. {e}')
+
+    def dump_haproxy_cfg(self) -> ConfigChange:
+        # the file is written only if its content changes; returns what it takes to apply the new config
+        cfg = self.build_haproxy_cfg()
+        change = cfg.diff(self.haproxy_config)
+        self.haproxy_config = cfg
+        ha_cfg = cfg.render()
+        cfg_path = 'haproxy_config/haproxy.cfg'
+        if os.path.exists(cfg_path):
+            with open(cfg_path) as fp:
+                if fp.read() == ha_cfg:
+                    return change
+        with open(cfg_path, 'w') as fp:
+            fp.write(ha_cfg)
+        logger.info(f'Wrote {cfg_path} ({cfg.digest()[:12]}).')
+        return change
+
+    def set_servers(self, servers: List[Tuple[str, Server]]) -> bool:
+        # moves servers to new addresses through the runtime API
+        commands = [f'set server {backend}/{server.name} addr {server.host} port {server.port}' for backend, server in servers]
+        ok = True
+        for cmd, ret in zip(commands, self.runtime.pipeline(commands)):
+            # success is reported as, e.g., `IP changed from ... to ...`
+            error = set_server_error(ret)
+            if error is not None:
+                logger.error(f'Error while updating a server. `{cmd}`: {error}')
+                ok = False
+        return ok
+
+    def reload(self):
+        # hold the lock, so that no traffic fetch reads the tables while the worker is replaced
+        with self.lock:
+            if not self.process.reload():
+                report_error()
+                return
+            # the new worker starts with every relay slot disabled
+            self.relays.reset()
+            self.reconcile_relays()
+            # counters are handed over by peers; read the whole table once and look up what was active
+            self.n_fetch_rounds = 0
+
+    def apply_node_update(self, new_node):
+        with self.lock:
+            # the tag and weight take effect at the next user sync, as they only filter users;
+            # properties and relays need a new config
+            self.copy_node_fields(new_node)
+            change = self.dump_haproxy_cfg()
+            if change.kind == 'runtime':
+                logger.warning(f'HAProxy servers changed: {[server.render() for _, server in change.servers]}.')
+                if self.set_servers(change.servers):
+                    return
+            if change.kind != 'none':
+                logger.warning('HAProxy config changed. Reloading.')
+                self.reload()
+            else:
+                self.reconcile_relays()
+
+    def update_relays(self, new_node):
+        # the other fields did not change: relays that only move are set by the runtime API,
+        # and only added or removed ones, or new ports, need a new config
+        def ports(node) -> Dict[int, Tuple[int, int]]:
+            return {relay.relay_id: relay.port_range() for relay in node.relay_out}
+
+        if ports(new_node) != ports(self.node_obj):
+            self.apply_node_update(new_node)
+            return
+        with self.lock:
+            self.node_obj.relay_out = new_node.relay_out
+            self.reconcile_relays()
+
+    def check_service(self):
+        if self.process.poll():
+            # also picks up new addresses of relay targets
+            self.reconcile_relays()
+            return
+        logger.error(f'HAProxy exited with code {self.process.proc.returncode}. Restarting.')
+        report_error()
+        with self.lock:
+            started = self.process.start()
+            self.n_fetch_rounds = 0
+            self.active_uids = set()
+            self.relays.reset()
+            if started:
+                self.reconcile_relays()
+
+    def stop(self):
+        with self.lock:
+            self.process.stop()
+        super().stop()
+
+    def talk(self, msg, need_return):
+        ret = self.runtime.execute(msg)
         if need_return:
-            ret = list()
-            while True:
-                piece = s.recv(1024000)
-                if not piece:
-                    break
-                ret.append(piece)
-            s.close()
-            ret = b''.join(ret)
-            return ret.decode()
-        else:
-            s.close()
+            return ret
 
     @staticmethod
     def sha1_map(user: User):
-        return hashlib.sha1(b'Basic ' + base64.b64encode(f'walless:{user.uuid}'.encode())).hexdigest().upper()
+        return sha1_map_key(user.uuid)
 
     def del_user(self, user: Account):
         # removing a user will delete its from the proxy table
         # but its traffic records will remain
         try:
-            self.talk(f'del map /tmp/usermap {self.sha1_map(user.user)}\n', False)
+            report = self.map_sync.update({}, [user.map_key])
+            if not report.ok:
+                logger.error(f'Failed to remove user {user.user}.')
         except Exception as e:
             logger.error(f'Exception while removing user {user.user}. {e}')
 
     def add_user(self, user: Account):
         try:
-            self.talk(f'add map /tmp/usermap {self.sha1_map(user.user)} {user.user.user_id}\n', False)
+            report = self.map_sync.update({user.map_key: user.user.user_id}, [])
+            if not report.ok:
+                logger.error(f'Failed to add user {user.user}.')
         except Exception as e:
             logger.error(f'Exception while adding user {user.user}. {e}')
 
-    def fetch_traffic(self):
-        pat = re.compile(r'key=(\d*) use.*?cnt=(\d*)')
-        for direction in ['in', 'out']:
-            table = self.talk('show table st_{}\n'.format(direction), True)
-            for uid, size in pat.findall(table):
-                uid, size = int(uid), int(size)
-                if uid in [0, 198964]:
+    @property
+    def table_mode(self):
+        # split: upload in st_in and download in st_out, which costs two dumps per round
+        # combined: both counters in st_traffic
+        # migrate: combined, and the counters left in st_in and st_out are moved into st_traffic once
+        for mode in ['combined', 'migrate']:
+            if f'{mode}_table' in self.node_obj.properties:
+                return mode
+        return 'split'
+
+    @property
+    def delta_fetch(self):
+        return 'delta_fetch' in self.node_obj.properties and self.table_mode != 'split'
+
+    @property
+    def traffic_tables(self) -> List[Tuple[str, List[str]]]:
+        # the tables read for traffic, and their counters
+        if self.table_mode == 'split':
+            return [('st_in', ['bytes_in_cnt']), ('st_out', ['bytes_out_cnt'])]
+        return [('st_traffic', ['bytes_in_cnt', 'bytes_out_cnt'])]
+
+    def check_epoch(self):
+        """
+        A traffic table without the epoch written by this service was reset, by a restart of HAProxy
+        that peers did not hand the table over to. The counters of the accounts are then rebased to
+        zero, keeping the traffic not reported yet, and a new epoch is written into every table.
+        Otherwise, the counters would stay below the old ones for a long time and go unreported.
+        Only called once the tables are resynced after a reload: before that, a table without the
+        epoch may just not have been copied into the new worker yet.
+        A table whose epoch could not be written is not taken as reset again: the write is retried,
+        and the counters are rebased once per reset.
+        """
+        tables = self.traffic_tables
+        replies = self.runtime.pipeline([f'show table {table} key {self.epoch_key}' for table, _ in tables])
+        n_reset, unwritten = 0, list()
+        for (table, columns), ret in zip(tables, replies):
+            found = list(parse_table([ret.encode()], columns[:1]))
+            epoch = found[0][1] if found else None
+            if epoch is not None and epoch == self.table_epoch:
+                continue
+            if epoch is None and table in self.unwritten_epochs:
+                unwritten.append(table)
+                continue
+            if self.table_epoch is not None:
+                logger.warning(f'Table {table} was reset (epoch {epoch}, expected {self.table_epoch}). Rebase the counters.')
+            for column in columns:
+                self.store.rebase('up' if column == 'bytes_in_cnt' else 'down')
+            n_reset += 1
+        if n_reset > 0:
+            self.table_epoch = int(time.time() * 1000)
+            unwritten = [table for table, _ in tables]
+        if not unwritten:
+            return
+        columns = dict(tables)
+        commands = [f'set table {table} key {self.epoch_key} data.{columns[table][0]} {self.table_epoch}' for table in unwritten]
+        self.unwritten_epochs = set()
+        for table, cmd, ret in zip(unwritten, commands, self.runtime.pipeline(commands)):
+            if ret.strip():
+                logger.error(f'Error while writing the table epoch. `{cmd}`: {ret.strip()}')
+                self.unwritten_epochs.add(table)
+
+    def iter_traffic(self) -> Iterator[Tuple[int, Optional[int], Optional[int]]]:
+        # the dump is parsed while it is being received, so the whole table never sits in memory
+        if self.table_mode == 'split':
+            for uid, size in parse_table(self.runtime.stream('show table st_in'), ['bytes_in_cnt']):
+                yield uid, size, None
+            for uid, size in parse_table(self.runtime.stream('show table st_out'), ['bytes_out_cnt']):
+                yield uid, None, size
+        else:
+            if self.delta_fetch:
+                yield from self.iter_traffic_delta()
+            else:
+                yield from parse_table(self.runtime.stream('show table st_traffic'), ['bytes_in_cnt', 'bytes_out_cnt'])
+
+    def iter_traffic_delta(self) -> Iterator[Tuple[int, int, int]]:
+        """
+        Only read the entries whose counters may have moved since the last round:
+        1. entries marked dirty (gpt0 = 1) by a request since the last round, whose flags are then cleared;
+        2. entries with running streams (conn_cur > 0), queried after the flags are cleared,
+           so that a stream starting in between is caught here;
+        3. entries that had running streams last round but not any more, to get their final counters.
+        The whole table is read every `full_fetch_gap` rounds to catch anything missed.
+        """
+        columns = ['gpt0', 'conn_cur', 'bytes_in_cnt', 'bytes_out_cnt']
+        full = self.n_fetch_rounds % self.full_fetch_gap == 0
+        self.n_fetch_rounds += 1
+        seen, dirty, active = set(), list(), set()
+
+        def read(command):
+            for uid, flag, n_conn, upload, download in parse_table(self.runtime.stream(command), columns):
+                if flag:
+                    dirty.append(uid)
+                if n_conn:
+                    active.add(uid)
+                if uid not in seen:
+                    seen.add(uid)
+                    yield uid, upload, download
+
+        yield from read('show table st_traffic' if full else 'show table st_traffic data.gpt0 gt 0')
+        self.runtime.pipeline([f'set table st_traffic key {uid} data.gpt0 0' for uid in dirty])
+        yield from read('show table st_traffic data.conn_cur gt 0')
+        ended = self.active_uids - seen
+        self.active_uids = active
+        yield from self.lookup_traffic(ended)
+        logger.debug(f'Fetched {len(seen) + len(ended)} entries ({"full" if full else "delta"}): '
+                     f'{len(dirty)} dirty, {len(active)} active, {len(ended)} ended.')
+
+    def lookup_traffic(self, uids: Iterable[int]) -> Iterator[Tuple[int, Optional[int], Optional[int]]]:
+        uids = list(uids)
+        tables = self.traffic_tables
+        traffic = {uid: [None, None] for uid in uids}
+        offset = 0
+        for table, columns in tables:
+            replies = self.runtime.pipeline(f'show table {table} key {uid}' for uid in uids)
+            for ret in replies:
+                for uid, *sizes in parse_table([ret.encode()], columns):
+                    traffic[uid][offset:offset + len(sizes)] = sizes
+            offset += len(columns)
+        for uid, (upload, download) in traffic.items():
+            yield uid, upload, download
+
+    def migrate_tables(self):
+        # The split tables are not tracked any more in migrate mode. Whatever they still hold
+        # (e.g., kept across a reload) is added onto st_traffic so that no usage history is lost.
+        # If the split tables still have the current epoch, so does st_traffic after the move:
+        # it continues the counters the accounts have.
+        # The sums are written first, and a user is cleared from the split tables only once its sum
+        # went through; users written in an earlier, failed attempt are only cleared, so that a retry
+        # never adds their traffic twice. Both commands set absolute values, so resending them is safe.
+        # Nothing is moved before the split tables are resynced after a reload: they would be moved
+        # only in part, and the rest would never be.
+        if not self.process.check_resync():
+            logger.warning('HAProxy tables are not resynced after the reload yet. Migrate them later.')
+            return
+        counters: Dict[int, List[int]] = dict()
+        # uid -> the split tables holding it
+        present: Dict[int, List[str]] = dict()
+        epochs = list()
+        for i, direction in enumerate(['in', 'out']):
+            table = self.runtime.stream(f'show table st_{direction}')
+            for uid, size in parse_table(table, [f'bytes_{direction}_cnt']):
+                if uid == self.epoch_key:
+                    epochs.append(size)
                     continue
-                if uid not in self.id2user:
+                counters.setdefault(uid, [0, 0])[i] = size
+                present.setdefault(uid, list()).append(f'st_{direction}')
+        if self.table_epoch is not None and epochs == [self.table_epoch] * 2:
+            self.runtime.execute(f'set table st_traffic key {self.epoch_key} data.bytes_in_cnt {self.table_epoch}')
+        n_failed = 0
+        pending = [uid for uid in counters if uid not in self.moved_uids]
+        if pending:
+            for uid, upload, download in parse_table(self.runtime.stream('show table st_traffic'), ['bytes_in_cnt', 'bytes_out_cnt']):
+                if uid in counters and uid not in self.moved_uids:
+                    counters[uid][0] += upload
+                    counters[uid][1] += download
+            commands = [
+                f'set table st_traffic key {uid} data.bytes_in_cnt {counters[uid][0]} data.bytes_out_cnt {counters[uid][1]}'
+                for uid in pending
+            ]
+            for uid, cmd, ret in zip(pending, commands, self.runtime.pipeline(commands)):
+                if ret.strip():
+                    logger.error(f'Error while migrating traffic tables. `{cmd}`: {ret.strip()}')
+                    n_failed += 1
+                else:
+                    self.moved_uids.add(uid)
+        cleared = [(uid, table) for uid in present if uid in self.moved_uids for table in present[uid]]
+        commands = [f'clear table {table} key {uid}' for uid, table in cleared]
+        for cmd, ret in zip(commands, self.runtime.pipeline(commands)):
+            if ret.strip():
+                logger.error(f'Error while migrating traffic tables. `{cmd}`: {ret.strip()}')
+                n_failed += 1
+        if n_failed > 0:
+            logger.error(f'{n_failed} commands failed while moving the counters of {len(counters)} users. Retry in the next round.')
+            return
+        logger.warning(f'Moved the counters of {len(counters)} users from st_in/st_out to st_traffic.')
+        self.moved_uids = set()
+        self.tables_migrated = True
+
+    def fetch_traffic(self, uids: Optional[List[int]] = None):
+        # look up a few given users, or go through the traffic tables
+        if uids is not None and len(uids) <= 1024:
+            traffic = self.lookup_traffic(uids)
+        else:
+            traffic = self.iter_traffic()
+        up_rows, uploads, down_rows, downloads = list(), list(), list(), list()
+        with self.lock:
+            if not self.process.check_resync():
+                # the tables of the new worker are still being filled by the local peer
+                logger.warning('HAProxy tables are not resynced after the reload yet. Skip this fetch.')
+                return
+            # the counters are moved before the epoch is checked, which may carry it over to st_traffic
+            if self.table_mode == 'migrate' and not self.tables_migrated:
+                self.migrate_tables()
+            self.check_epoch()
+            for uid, upload, download in traffic:
+                if uid in [0, 198964, self.epoch_key]:
+                    continue
+                account = self.id2user.get(uid)
+                if account is None:
                     # this is a deleted account; ignore it
                     continue
-                if direction == 'in':
-                    self.id2user[uid].update_traffic(upload=size)
-                else:
-                    self.id2user[uid].update_traffic(download=size)
+                if upload is not None:
+                    up_rows.append(account.row)
+                    uploads.append(upload)
+                if download is not None:
+                    down_rows.append(account.row)
+                    downloads.append(download)
+            self.store.update_many('up', up_rows, uploads)
+            self.store.update_many('down', down_rows, downloads)
 
     def sync_users(self):
-        new_users, del_users = self.fetch_user_config()
+        fetched_users = self.pull_user_config()
+
+        # hold the lock from the diff until the new users are reset, so that traffic sampling
+        # never reports the old counters of a re-enabled user
+        with self.lock:
+            new_users, del_users = self.diff_user_config(fetched_users)
+            # an altered user is in both lists: its old key is removed and the new one added.
+            # The old keys are taken in every case, so that none is left over for a later round.
+            removed = [u.map_key if u.prev_map_key is None else u.prev_map_key for u in del_users]
+            for u in del_users:
+                u.prev_map_key = None
+
+            # If alert file exists, delete all users
+            if os.path.exists('/tmp/stop_walless'):
+                logger.warning('Disable all users because stop_walless exists.')
+                new_users = []
+                desired = dict([self.placeholder])
+                self.stopped = True
+            elif self.stopped:
+                # bring back everyone after stop_walless is removed
+                new_users = list(self.id2user.values())
+                desired = {u.map_key: uid for uid, u in self.id2user.items()}
+                desired.update([self.placeholder])
+                self.stopped = False
+            else:
+                desired = None
 
-        # If alert file exists, delete all users
-        if os.path.exists('/tmp/stop_walless'):
-            logger.warning('Disable all users because stop_walless exists.')
-            new_users = []
-            del_users = [u for u in self.id2user.values()]
+            # the whole change set of this round is applied to the map at once
+            try:
+                if desired is None:
+                    report = self.map_sync.update({u.map_key: u.user.user_id for u in new_users}, removed)
+                else:
+                    report = self.map_sync.sync(desired, swap=True)
+                if report.n_added + report.n_removed > 0:
+                    logger.warning(f'User map synced. {report}.')
+                if not report.ok:
+                    logger.error('Failed to sync the user map. Will retry in the next round.')
+            except Exception as e:
+                logger.error(f'Exception while syncing the user map. {e}')
 
-        for u in del_users:
-            self.del_user(u)
-        for u in new_users:
-            self.add_user(u)
+            # sync its traffic with the record of haproxy, in case the user is re-enabled
+            # and had traffics before
+            # but we won't report the traffic difference to database
+            if new_users:
+                self.fetch_traffic([u.user.user_id for u in new_users])
+                self.store.reset([u.row for u in new_users])
 
-        # sync its traffic with the record of haproxy, in case the user is re-enabled
-        # and had traffics before
-        # but we won't report the traffic difference to database
-        if new_users:
-            self.fetch_traffic()
-            for u in new_users:
-                u.reset()
+        self.save_snapshot(len(new_users) + len(del_users) > 0)
 
 
 haproxy_cfg = '''
@@ -136,7 +485,7 @@ global
     maxconn 65535
     lua-load haproxy_config/h2p.lua
     stats timeout 1m
-    stats socket /tmp/haproxy.sock mode 600 level admin
+    stats socket /tmp/haproxy.sock mode 600 level admin expose-fd listeners
     ssl-default-bind-ciphersuites TLS_AES_128_GCM_SHA256
 
 defaults
@@ -148,20 +497,19 @@ defaults
     timeout tunnel 15m
     option splice-auto
 
+peers local
+    # stick tables are handed over to the new worker on reload; the name is given by `-L`
+    peer walless 127.0.0.1:10000
+
 resolvers mydns
     nameserver cloudflare 1.1.1.1:53
     nameserver google 8.8.8.8:53
     timeout retry 2s
     hold valid 10s
 
-backend st_in
-    stick-table type integer size 1m nopurge store bytes_in_cnt
-
-backend st_out
-    stick-table type integer size 1m nopurge store bytes_out_cnt
-
+$TRAFFIC_TABLES$
 backend st_rate
-    stick-table type integer size 1m nopurge store gpc0,http_req_rate(1s)
+    stick-table type integer size 1m nopurge peers local store gpc0,http_req_rate(1s)
 
 backend h2pproxy
     mode http
@@ -193,8 +541,7 @@ frontend main_proxy
     http-request set-var(req.userid) hdr(Proxy-Authorization),sha1,hex,map_str_int(/tmp/usermap,0)
 
     # save user traffic to track-sc table (in and out)
-    http-request track-sc0 var(req.userid) table st_in
-    http-request track-sc1 var(req.userid) table st_out
+$TRACK_TRAFFIC$
     http-request track-sc2 var(req.userid) table st_rate
     
     # ===== copied from haproxy Configuration Manual =====
@@ -216,6 +563,31 @@ frontend main_proxy
     
 '''
 
+split_tables = '''\
+backend st_in
+    stick-table type integer size 1m nopurge peers local store bytes_in_cnt
+
+backend st_out
+    stick-table type integer size 1m nopurge peers local store bytes_out_cnt
+'''
+
+combined_table = '''\
+backend st_traffic
+    stick-table type integer size 1m nopurge peers local store bytes_in_cnt,bytes_out_cnt
+'''
+
+# table definitions and tracking rules for each traffic table mode
+traffic_table_cfg = {
+    'split': (split_tables, '''\
+    http-request track-sc0 var(req.userid) table st_in
+    http-request track-sc1 var(req.userid) table st_out'''),
+    'combined': (combined_table, '''\
+    http-request track-sc0 var(req.userid) table st_traffic'''),
+    # st_in and st_out are kept (but no longer tracked) until their counters are moved to st_traffic
+    'migrate': (split_tables + '\n' + combined_table, '''\
+    http-request track-sc0 var(req.userid) table st_traffic'''),
+}
+
 gre_suffix = '''
 
 resolvers edns
@@ -254,8 +626,7 @@ frontend main_proxy
     http-request set-var(req.userid) hdr(Proxy-Authorization),sha1,hex,map_str_int(/tmp/usermap,0)
 
     # save user traffic to track-sc table (in and out)
-    http-request track-sc0 var(req.userid) table st_in
-    http-request track-sc1 var(req.userid) table st_out
+$TRACK_TRAFFIC$
     http-request track-sc2 var(req.userid) table st_rate
 
     # ===== copied from haproxy Configuration Manual =====
@@ -303,8 +674,7 @@ frontend main_proxy_gre
     http-request set-var(req.userid) hdr(Proxy-Authorization),sha1,hex,map_str_int(/tmp/usermap,0)
 
     # save user traffic to track-sc table (in and out)
-    http-request track-sc0 var(req.userid) table st_in
-    http-request track-sc1 var(req.userid) table st_out
+$TRACK_TRAFFIC$
     http-request track-sc2 var(req.userid) table st_rate
 
     # ===== copied from haproxy Configuration Manual =====
@@ -0,0 +1,175 @@
+from typing import *
+import os
+import re
+import time
+import logging
+from dataclasses import dataclass, field
+
+from .runtime import RuntimeAPI
+
+logger = logging.getLogger('walless')
+
+# in prompt mode, HAProxy answers every line of a payload with a `+ ` continuation prompt
+CONTINUATION = re.compile(r'(?:^|(?<=\s))\+(?=\s|$)')
+
+
+@dataclass()
+class MapSyncReport:
+    mode: str = 'noop'
+    n_added: int = 0
+    n_removed: int = 0
+    # number of map entries sent to HAProxy
+    n_written: int = 0
+    # (entries, seconds) of every pipelined write
+    batches: List[Tuple[int, float]] = field(default_factory=list)
+    time_cost: float = 0.
+    ok: bool = True
+
+    def __str__(self):
+        return f'{self.mode}: +{self.n_added} -{self.n_removed}, wrote {self.n_written} entries ' \
+               f'in {len(self.batches)} batches, {self.time_cost:.3f}s'
+
+
+class MapSync:
+    """
+    Keeps a HAProxy map in line with a desired {key: value} dict.
+
+    We mirror what HAProxy currently holds (starting from the map file it loaded) and compute the delta
+    against the desired content. A small delta (at most `patch_ratio` of the map, or `patch_min` entries)
+    is applied with pipelined `del map`/`add map`/`set map`. A bulk change, or a sync asked to `swap`,
+    builds a new map version with `prepare map` + multi-line `add map @<ver>` payloads and swaps it in
+    with `commit map`: HAProxy serves the old version until the commit, so a failure halfway leaves the
+    map untouched, and the change is then applied incrementally instead.
+    The desired content is kept, and the next sync or update retries what failed.
+    HAProxy without map versions (< 2.4) always gets the incremental updates.
+    """
+
+    def __init__(self, runtime: RuntimeAPI, path: str = '/tmp/usermap', chunk_size: int = 256, group_size: int = 16,
+                 patch_ratio: float = 0.05, patch_min: int = 64):
+        self.runtime = runtime
+        self.path = path
+        # entries per `add map` payload; a payload must fit into HAProxy's tune.bufsize (16k by default)
+        self.chunk_size = chunk_size
+        # payloads per pipelined write
+        self.group_size = group_size
+        # deltas up to max(patch_min, patch_ratio * map size) entries are applied incrementally
+        self.patch_ratio = patch_ratio
+        self.patch_min = patch_min
+        self.transactional = True
+        self.current: Dict[str, str] = self.load(path)
+        self.desired: Dict[str, str] = self.current.copy()
+
+    @staticmethod
+    def load(path) -> Dict[str, str]:
+        ret = dict()
+        if not os.path.exists(path):
+            return ret
+        with open(path) as fp:
+            for line in fp:
+                line = line.split('#', 1)[0].split()
+                if len(line) == 2:
+                    ret[line[0]] = line[1]
+        return ret
+
+    def dump(self):
+        # keep the file in line with the memory, so that HAProxy loads the latest map when it starts again
+        tmp_path = self.path + '.tmp'
+        with open(tmp_path, 'w') as fp:
+            fp.writelines(f'{k} {v}\n' for k, v in self.current.items())
+        os.replace(tmp_path, self.path)
+
+    def update(self, added: Dict[str, Any], removed: Iterable[str]) -> MapSyncReport:
+        # changes on top of the desired content, including what earlier failed syncs did not apply
+        if not added and not removed and self.desired == self.current:
+            return MapSyncReport()
+        desired = self.desired.copy()
+        for k in removed:
+            desired.pop(k, None)
+        desired.update(added)
+        return self.sync(desired)
+
+    def sync(self, desired: Dict[str, Any], swap: bool = False) -> MapSyncReport:
+        # with `swap`, the map is replaced as a whole whatever the size of the delta
+        since = time.time()
+        desired = {k: str(v) for k, v in desired.items()}
+        self.desired = desired
+        added = {k: v for k, v in desired.items() if self.current.get(k) != v}
+        removed = [k for k in self.current if k not in desired]
+        report = MapSyncReport(n_added=len(added), n_removed=len(removed))
+        if len(added) + len(removed) == 0:
+            return report
+
+        n_changes = len(added) + len(removed)
+        use_swap = self.transactional and (swap or n_changes > max(self.patch_min, self.patch_ratio * len(desired)))
+        if use_swap:
+            report.mode = 'commit'
+            report.ok = self._swap(desired, report)
+            if not report.ok and self.transactional:
+                logger.warning(f'Failed to swap in a new map version. Apply the {n_changes} changes incrementally.')
+        if not use_swap or not report.ok:
+            report.mode = 'incremental'
+            report.ok = self._patch(added, removed, report)
+        if report.ok:
+            self.current = desired
+            self.dump()
+        report.time_cost = time.time() - since
+        return report
+
+    def _write(self, commands: List[str], n_entries: List[int], report: MapSyncReport, group_size: int) -> List[str]:
+        replies = list()
+        for i in range(0, len(commands), group_size):
+            since = time.time()
+            replies.extend(self.runtime.pipeline(commands[i:i + group_size]))
+            n = sum(n_entries[i:i + group_size])
+            report.batches.append((n, time.time() - since))
+            report.n_written += n
+        return replies
+
+    def _swap(self, desired: Dict[str, str], report: MapSyncReport) -> bool:
+        ret = self.runtime.execute(f'prepare map {self.path}')
+        if not ret.startswith('New version created:'):
+            logger.warning(f'HAProxy does not support map versions ({ret.strip()}). Fall back to incremental updates.')
+            self.transactional = False
+            return False
+        version = ret.split(':')[1].strip()
+
+        items = [f'{k} {v}' for k, v in desired.items()]
+        commands, n_entries = list(), list()
+        for i in range(0, len(items), self.chunk_size):
+            chunk = items[i:i + self.chunk_size]
+            commands.append('\n'.join([f'add map @{version} {self.path} <<'] + chunk) + '\n\n')
+            n_entries.append(len(chunk))
+        for cmd, ret in zip(commands, self._write(commands, n_entries, report, self.group_size)):
+            ret = CONTINUATION.sub('', ret).strip()
+            if ret:
+                logger.error(f'Failed to fill map version {version}: {ret}. Nothing is committed.')
+                return False
+        ret = self.runtime.execute(f'commit map @{version} {self.path}')
+        if ret.strip():
+            logger.error(f'Failed to commit map version {version}: {ret.strip()}')
+            return False
+        return True
+
+    def _patch(self, added: Dict[str, str], removed: List[str], report: MapSyncReport) -> bool:
+        commands = [f'del map {self.path} {k}' for k in removed]
+        for k, v in added.items():
+            verb = 'set' if k in self.current else 'add'
+            commands.append(f'{verb} map {self.path} {k} {v}')
+        ok = True
+        for cmd, ret in zip(commands, self._write(commands, [1] * len(commands), report, self.runtime.batch_size)):
+            if ret.strip():
+                logger.error(f'Error while running `{cmd}`: {ret.strip()}')
+                ok = False
+        if not ok:
+            # we no longer know what HAProxy holds; read it back so that the next round fixes the difference
+            self.current = self.show()
+        return ok
+
+    def show(self) -> Dict[str, str]:
+        ret = dict()
+        # lines of `show map` look like `0x55d8e0a4c2b0 <key> <value>`
+        for line in self.runtime.execute(f'show map {self.path}').splitlines():
+            line = line.split()
+            if len(line) == 3:
+                ret[line[1]] = line[2]
+        return ret
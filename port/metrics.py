@@ -0,0 +1,191 @@
+from typing import *
+from bisect import bisect_left
+import os
+import threading
+import socketserver
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+
+class Histogram:
+    """
+    A cumulative histogram with fixed bucket upper bounds, in the same shape as a Prometheus histogram.
+    """
+    kind = 'histogram'
+    DEFAULT_BUCKETS = (.005, .01, .025, .05, .1, .25, .5, 1., 2.5, 5., 10., 30., 60., 120., 300.)
+
+    def __init__(self, buckets: Sequence[float] = DEFAULT_BUCKETS):
+        self.buckets = tuple(sorted(buckets))
+        # the last one counts the observations above every bound
+        self.counts = [0] * (len(self.buckets) + 1)
+        self.sum = 0.
+        self.count = 0
+        self.lock = threading.Lock()
+
+    def observe(self, value: float):
+        with self.lock:
+            self.counts[bisect_left(self.buckets, value)] += 1
+            self.sum += value
+            self.count += 1
+
+    def quantile(self, q: float) -> float:
+        # upper bound of the bucket holding the q-quantile; inf if it is above every bound
+        with self.lock:
+            rank = q * self.count
+            acc = 0
+            for bound, n in zip(self.buckets, self.counts):
+                acc += n
+                if acc >= rank and acc > 0:
+                    return bound
+        return float('inf')
+
+    def __str__(self):
+        if self.count == 0:
+            return 'no samples'
+        return f'n={self.count} avg={self.sum / self.count:.3f}s p50<={self.quantile(.5)}s ' \
+               f'p90<={self.quantile(.9)}s p99<={self.quantile(.99)}s'
+
+    def samples(self) -> List[Tuple[str, Dict[str, str], float]]:
+        # (suffix, extra labels, value) in the Prometheus exposition format
+        with self.lock:
+            counts, total, count = list(self.counts), self.sum, self.count
+        ret, acc = list(), 0
+        for bound, n in zip(self.buckets, counts):
+            acc += n
+            ret.append(('_bucket', {'le': repr(float(bound))}, acc))
+        ret.append(('_bucket', {'le': '+Inf'}, count))
+        ret += [('_sum', {}, total), ('_count', {}, count)]
+        return ret
+
+
+class Counter:
+    """
+    A value that only goes up. With `func`, the value is read from it instead, e.g., from a counter
+    an object keeps anyway.
+    """
+    kind = 'counter'
+
+    def __init__(self, func: Optional[Callable[[], float]] = None):
+        self.func = func
+        self._value = 0.
+        self.lock = threading.Lock()
+
+    def inc(self, n: float = 1):
+        with self.lock:
+            self._value += n
+
+    @property
+    def value(self) -> float:
+        return self.func() if self.func is not None else self._value
+
+    def samples(self) -> List[Tuple[str, Dict[str, str], float]]:
+        return [('', {}, self.value)]
+
+
+class Gauge(Counter):
+    # a value that goes up and down
+    kind = 'gauge'
+
+    def set(self, value: float):
+        self._value = value
+
+
+class Registry:
+    """
+    Metrics by name and labels, rendered in the Prometheus text format. Asking for a metric with
+    the name and labels of an existing one returns the existing one.
+    """
+
+    def __init__(self):
+        # name -> (kind, help, {sorted labels: metric})
+        self.metrics: Dict[str, Tuple[str, str, Dict[Tuple[Tuple[str, str], ...], Any]]] = dict()
+        self.lock = threading.Lock()
+
+    def register(self, name: str, metric, help: str = '', **labels):
+        key = tuple(sorted((k, str(v)) for k, v in labels.items()))
+        with self.lock:
+            kind, _, children = self.metrics.setdefault(name, (metric.kind, help, dict()))
+            if kind != metric.kind:
+                raise ValueError(f'{name} is a {kind}, not a {metric.kind}.')
+            return children.setdefault(key, metric)
+
+    def counter(self, name: str, help: str = '', func: Optional[Callable[[], float]] = None, **labels) -> Counter:
+        return self.register(name, Counter(func), help, **labels)
+
+    def gauge(self, name: str, help: str = '', func: Optional[Callable[[], float]] = None, **labels) -> Gauge:
+        return self.register(name, Gauge(func), help, **labels)
+
+    def histogram(self, name: str, help: str = '', buckets: Sequence[float] = Histogram.DEFAULT_BUCKETS,
+                  **labels) -> Histogram:
+        return self.register(name, Histogram(buckets), help, **labels)
+
+    @staticmethod
+    def _labels(labels: Iterable[Tuple[str, str]]) -> str:
+        labels = list(labels)
+        if not labels:
+            return ''
+        return '{' + ','.join('{}="{}"'.format(k, v.replace('\\', '\\\\').replace('"', '\\"')) for k, v in labels) + '}'
+
+    def render(self) -> str:
+        lines = list()
+        with self.lock:
+            metrics = [(name, kind, help, list(children.items())) for name, (kind, help, children) in sorted(self.metrics.items())]
+        for name, kind, help, children in metrics:
+            if help:
+                lines.append(f'# HELP {name} {help}')
+            lines.append(f'# TYPE {name} {kind}')
+            for key, metric in children:
+                try:
+                    samples = metric.samples()
+                except Exception:
+                    # a broken func does not take the other metrics down
+                    continue
+                for suffix, extra, value in samples:
+                    lines.append(f'{name}{suffix}{self._labels(list(key) + list(extra.items()))} {float(value)!r}')
+        return '\n'.join(lines) + '\n'
+
+
+REGISTRY = Registry()
+
+
+class _MetricsHandler(BaseHTTPRequestHandler):
+    registry = REGISTRY
+
+    def do_GET(self):
+        body = self.registry.render().encode()
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/plain; version=0.0.4; charset=utf-8')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def address_string(self):
+        # clients of a Unix socket have no address
+        return str(self.client_address[0]) if self.client_address else 'local'
+
+    def log_message(self, format, *args):
+        pass
+
+
+class _UnixHTTPServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    daemon_threads = True
+
+    def get_request(self):
+        request, _ = super().get_request()
+        return request, ('local', 0)
+
+
+def serve_metrics(address: str, registry: Registry = REGISTRY):
+    """
+    Serve `registry` over HTTP on a background thread, at `address`: a Unix socket path (starting
+    with /), or host:port. `curl --unix-socket <path> http://localhost/metrics` reads a Unix socket.
+    """
+    handler = type('MetricsHandler', (_MetricsHandler,), {'registry': registry})
+    if address.startswith('/'):
+        if os.path.exists(address):
+            os.unlink(address)
+        server = _UnixHTTPServer(address, handler)
+    else:
+        host, _, port = address.rpartition(':')
+        server = ThreadingHTTPServer((host or '127.0.0.1', int(port)), handler)
+    threading.Thread(target=server.serve_forever, name='metrics', daemon=True).start()
+    return server
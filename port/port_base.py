@@ -3,28 +3,65 @@ import random
 import os
 from datetime import datetime, timedelta
 import time
-from copy import deepcopy
+from threading import RLock
 import logging
 
 import pytz
 from walless_utils import Node,  db, user_pool, node_pool
 from walless_utils.network_status import NetworkStatus
-from walless_utils import EditReservior
 
 from .utils import report_active_user, restart, report_error
 from .account import Account
-from .cron import CronJob, CronManager
+from .account_store import AccountStore
+from .cron import CronJob, CronManager, AsyncCronJob, AsyncCronManager
+from .uploader import TrafficWriter
+from .spool import TrafficSpool
+from .snapshot import Snapshot, SnapshotEntry, SnapshotUser, snapshot_path
+from .metrics import REGISTRY
 
 logger = logging.getLogger('walless')
 
+USERS = REGISTRY.gauge('walless_users', 'Users on this node')
+ACTIVE_USERS = REGISTRY.gauge('walless_active_users', 'Users with more than 1MiB of traffic in the last upload')
+USER_CHANGES = {
+    change: REGISTRY.counter('walless_user_changes_total', 'Users added, altered and removed', change=change)
+    for change in ['added', 'altered', 'removed']
+}
+
 
 class PortBase:
-    def __init__(self, node_obj: Node, network_status: NetworkStatus = None):
+    # fields of a node that are read from the database by `check_node_update`
+    node_fields = ['tag', 'weight', 'properties']
+
+    def __init__(self, node_obj: Node, network_status: NetworkStatus = None, pull_users: Optional[Callable] = None,
+                 pull_node: Optional[Callable] = None):
         self.root = os.environ.get('WALLESS_ROOT', os.environ.get('HOME'))
         self.network_status = network_status if network_status is None else NetworkStatus()
         self.node_obj = node_obj
         self.id2user: Dict[int, Account] = dict()
+        # traffic counters of the accounts in id2user
+        self.store = AccountStore()
+        # user_id -> uuid of the last fetched users
+        self.user_versions: Dict[int, str] = dict()
+        self.full_diff_gap = 60
+        self.n_diff_rounds = 0
         self.n_active = 0
+        # guards id2user and the accounts, which the user sync and traffic sampling stages share
+        self.lock = RLock()
+        self.writer = TrafficWriter(TrafficSpool(os.path.join(self.root, '.var', 'traffic_spool')))
+        # users of the last run, to serve them before the database is read
+        self.snapshot = Snapshot(snapshot_path(self.root))
+        # save the snapshot at least once every `snapshot_gap` user syncs
+        self.snapshot_gap = 10
+        # written into the traffic tables to tell whether they were reset since the counters were read
+        self.table_epoch: Optional[int] = None
+        self.n_snapshot_rounds = 0
+        # loads users from the database into user_pool; given when the service starts from a snapshot,
+        # and called by the first user sync
+        self.pull_users = pull_users
+        # returns this node freshly pulled with its relays; without it, `check_node_update` only reads
+        # the fields of the node from the database, and the relays stay as they were at start
+        self.pull_node = pull_node
 
         self.cron_mgr = CronManager()
 
@@ -33,33 +70,61 @@ class PortBase:
         return len(self.id2user)
 
     def fetch_user_config(self):
-        fetched_users = user_pool.all_users()
-        if self.node_obj.weight > 1e-3:
-            # We do not check balance for free node.
-            fetched_users = list(filter(lambda x: x.balance > 1024, fetched_users))
-        fetched_users = list(filter(lambda x: self.node_obj.can_be_used_by(x.tag), fetched_users))
+        fetched_users = self.pull_user_config()
+        with self.lock:
+            return self.diff_user_config(fetched_users)
+
+    def pull_user_config(self):
+        # the users that may use this node; this is the slow part, and touches no local state
+        if self.pull_users is not None:
+            since = time.time()
+            self.pull_users()
+            self.pull_users = None
+            logger.warning(f'Pulled users in the background. Time cost: {time.time() - since:.2f}s.')
+        # We do not check balance for free node.
+        check_balance = self.node_obj.weight > 1e-3
+        return [
+            u for u in user_pool.all_users()
+            if (not check_balance or u.balance > 1024) and self.node_obj.can_be_used_by(u.tag)
+        ]
+
+    def diff_user_config(self, fetched_users):
+        # The uuid is the version of a user: the map only depends on it. Comparing {user_id: uuid}
+        # with the last round is done by dict and set operations in C, so a round without change
+        # costs one dict build, and only the changed users go through the loop below.
+        # Every `full_diff_gap` rounds, everything is compared against id2user instead.
+        versions = {u.user_id: u.uuid for u in fetched_users}
+        full = self.n_diff_rounds % self.full_diff_gap == 0
+        self.n_diff_rounds += 1
+        if full:
+            missing_user_ids = self.id2user.keys() - versions.keys()
+        elif versions == self.user_versions:
+            return [], []
+        else:
+            changed_ids = {uid for uid, _ in versions.items() - self.user_versions.items()}
+            fetched_users = [u for u in fetched_users if u.user_id in changed_ids]
+            missing_user_ids = (self.user_versions.keys() - versions.keys()) & self.id2user.keys()
+        self.user_versions = versions
 
         n_new = n_alter = n_del = 0
         new_users, del_users = list(), list()
-        missing_user_ids = set(self.id2user.keys())
         for u in fetched_users:
-            missing_user_ids.discard(u.user_id)
             if u.user_id in self.id2user:
                 # this user existsed in local record
                 if u.uuid == self.id2user[u.user_id].user.uuid:
-                    # no change happened to this user
-                    pass
+                    # no change happened to the map of this user; keep the fetched copy, which also
+                    # replaces the SnapshotUser of a user restored from the snapshot
+                    self.id2user[u.user_id].user = u
                 else:
                     logger.warning(f'User {u} config changed.')
-                    # delete the old user. copy its uuid
-                    del_users.append(deepcopy(self.id2user[u.user_id]))
-                    # assign new uuid to local copy of this user
-                    self.id2user[u.user_id].user = u
+                    # assign new uuid to local copy of this user; it remembers the old map key to delete
+                    self.id2user[u.user_id].rekey(u)
+                    del_users.append(self.id2user[u.user_id])
                     new_users.append(self.id2user[u.user_id])
                     n_alter += 1
             else:
                 # this is a new user. it might just register, or it is re-enabled
-                self.id2user[u.user_id] = Account(u)
+                self.id2user[u.user_id] = Account(u, self.store)
                 new_users.append(self.id2user[u.user_id])
                 n_new += 1
 
@@ -67,88 +132,183 @@ class PortBase:
             # this user existed in local record but now missing in database
             # it might be disabled, or its balance is empty
             logger.info(f'User {self.id2user[uid].user} is going to be disabled.')
-            del_users.append(self.id2user.pop(uid))
+            account = self.id2user.pop(uid)
+            account.release()
+            del_users.append(account)
             n_del += 1
 
         if len(new_users) + len(del_users) > 0:
             logger.warning(f'Added {n_new}, altered {n_alter}, and deleted {n_del} users.')
+            for change, n in zip(['added', 'altered', 'removed'], [n_new, n_alter, n_del]):
+                USER_CHANGES[change].inc(n)
+        USERS.set(len(self.id2user))
 
         return new_users, del_users
 
+    def restore_snapshot(self) -> List[Account]:
+        # the accounts are restored with their map keys; they are reconciled with the database by
+        # the first user sync. The counters are restored as reported, and rebased by the first
+        # traffic fetch unless the tables still have the epoch of the snapshot.
+        entries = self.snapshot.load()
+        with self.lock:
+            self.table_epoch = self.snapshot.epoch
+            for entry in entries:
+                account = Account(SnapshotUser(entry.user_id, entry.uuid), self.store, entry.map_key)
+                self.store.up[account.row] = self.store.last_up[account.row] = entry.last_up
+                self.store.down[account.row] = self.store.last_down[account.row] = entry.last_down
+                self.id2user[entry.user_id] = account
+        if entries:
+            logger.warning(f'Restored {len(entries)} users from {self.snapshot.path}.')
+        return [self.id2user[entry.user_id] for entry in entries]
+
+    def save_snapshot(self, changed: bool = True):
+        # called after a user sync; written if the users changed, or every `snapshot_gap` rounds
+        self.n_snapshot_rounds += 1
+        if not changed and self.n_snapshot_rounds < self.snapshot_gap:
+            return
+        self.n_snapshot_rounds = 0
+        with self.lock:
+            entries = [
+                SnapshotEntry(uid, account.user.uuid, account.map_key, *account.last_traffic)
+                for uid, account in self.id2user.items()
+            ]
+            epoch = self.table_epoch
+        try:
+            self.snapshot.save(entries, epoch)
+        except OSError as e:
+            logger.error(f'Cannot save the snapshot of {len(entries)} users: {e}')
+
     def upload_traffic(self):
-        to_update = dict()
-        n_total = 0
         # user with more than 1MB traffic will be considered as active
-        n_active = 0
         active_threshold = 1 * 1024**2
-        for u in self.id2user.values():
-            u_delta, d_delta = u.diff()
-            if u_delta + d_delta == 0:
-                continue
-            n_total += 1
-            if not u.need_report():
-                continue
-            to_update[u.user.user_id] = (u_delta, d_delta)
-            if sum(to_update[u.user.user_id]) > active_threshold:
-                n_active += 1
-            u.reset()
-        report_active_user(n_active)
-        self.n_active = n_active
-        logger.info('Found {} pieces of updates, {} among which will be uploaded.'.format(n_total, len(to_update)))
-        if len(to_update) == 0:
-            return
-        editor = EditReservior(sql=db.upload_log_sql, db=db, block=True, cache_size=1024)
-        now = int(time.time())
-        for user_id, (u_delta, d_delta) in to_update.items():
-            editor.add((user_id, self.node_obj.uuid, u_delta, d_delta, now))
-        editor.flush()
+        with self.lock:
+            rows, uids, u_deltas, d_deltas, n_total, n_active = self.store.collect(active_threshold)
+            report_active_user(n_active)
+            self.n_active = n_active
+            ACTIVE_USERS.set(n_active)
+            logger.info('Found {} pieces of updates, {} among which will be uploaded.'.format(n_total, len(rows)))
+            if len(rows) == 0:
+                return
+            now = int(time.time())
+            node_uuid = self.node_obj.uuid
+            records = [(uid, node_uuid, u_delta, d_delta, now) for uid, u_delta, d_delta in zip(uids, u_deltas, d_deltas)]
+            # deltas are reset once they are safe in the spool; the DB write happens on the writer thread
+            if self.writer.submit(records):
+                self.store.reset(rows)
 
-    def sync_db(self):
-        loop_since = time.time()
+    def enable_profiling(self, profiler):
+        # the stages are looked up on the instance when they run, so the wrappers take their place
+        for name in ['sync_users', 'fetch_traffic', 'upload_traffic', 'check_node_update']:
+            setattr(self, name, profiler.wrap(getattr(self, name), name))
 
-        def action(func, name):
-            try:
-                since = time.time()
-                func()
-                logger.info(f'Finished {name}. Time cost: {time.time()-since:.3f}sec.')
-            except Exception as e:
-                logger.error(f'Error while {name}: {e}')
-                raise e
+    def stage(self, func, name):
+        try:
+            since = time.time()
+            func()
+            REGISTRY.histogram('walless_stage_seconds', 'Time of the stages of the sync loop', stage=name).observe(time.time() - since)
+            logger.info(f'Finished {name}. Time cost: {time.time()-since:.3f}sec.')
+        except Exception as e:
+            REGISTRY.counter('walless_stage_errors_total', 'Errors in the stages of the sync loop', stage=name).inc()
+            logger.error(f'Error while {name}: {e}')
+            raise e
 
-        action(self.sync_users, 'user config fetching')
-        action(self.fetch_traffic, 'traffic fetching')
-        action(self.upload_traffic, 'traffic uploading')
+    def sync_user_config(self):
+        # runs on its own schedule; the DB read does not hold up traffic sampling
+        self.stage(self.sync_users, 'user config fetching')
 
+    def sample_traffic(self):
+        loop_since = time.time()
+        self.stage(self.fetch_traffic, 'traffic fetching')
+        self.stage(self.upload_traffic, 'traffic uploading')
         logger.warning(f'Loop done in {time.time() - loop_since:.3f}s. {self.n_active}/{self.n_user} active users.')
 
+    def sync_db(self):
+        # one round of every stage, one after another
+        self.sync_user_config()
+        self.sample_traffic()
+
     def check_node_update(self):
-        new_node = db.get_node_by_uuid(self.node_obj.uuid)
+        if self.pull_node is not None:
+            new_node = self.pull_node()
+        else:
+            new_node = db.get_node_by_uuid(self.node_obj.uuid)
 
         def has_update():
             if new_node is None:
                 return False
-            for k in ['tag', 'weight', 'properties']:
+            for k in self.node_fields:
                 if getattr(new_node, k) != getattr(self.node_obj, k):
                     return True
             return False
 
         if has_update():
-            os.system('/usr/bin/rebot')
+            logger.warning(f'Node config changed. Tag: {new_node.tag}, weight: {new_node.weight}, '
+                           f'properties: {new_node.properties}.')
+            self.apply_node_update(new_node)
+        elif new_node is not None and self.pull_node is not None:
+            self.update_relays(new_node)
+
+    def update_relays(self, new_node: Node):
+        # the node pulled by `pull_node` may have other relays
+        pass
+
+    def apply_node_update(self, new_node: Node):
+        os.system('/usr/bin/rebot')
+
+    def copy_node_fields(self, new_node: Node):
+        # node_obj keeps what whoami set up with it; only the fields read from the database are taken
+        for k in self.node_fields:
+            setattr(self.node_obj, k, getattr(new_node, k))
+        if self.pull_node is not None:
+            # a pulled node comes with its relays
+            self.node_obj.relay_out = new_node.relay_out
+
+    def check_service(self):
+        # restart the proxy if it died
+        pass
+
+    def stop(self):
+        # stop the proxy and the traffic writer, before another job takes over
+        self.writer.stop()
+
+    @staticmethod
+    def seconds_to_restart():
+        # seconds to a random time between 4:00 and 4:10 am
+        now = datetime.fromtimestamp(int(time.time()), pytz.timezone('Asia/Shanghai'))
+        now = now.replace(tzinfo=None)
+        next4am = datetime(year=now.year, month=now.month, day=now.day, hour=4) + timedelta(days=1)
+        return (next4am - now).seconds + 600 * random.random()
 
     def run(self):
-        self.cron_mgr.new_job(CronJob('sync_db', self.sync_db, 1, 360, in_error=report_error))
+        self.cron_mgr.new_job(CronJob('sync_users', self.sync_user_config, 1, 360, in_error=report_error))
+        self.cron_mgr.new_job(CronJob('sample_traffic', self.sample_traffic, 1, 360, in_error=report_error))
 
         if 'restart' in self.node_obj.properties:
-            now = datetime.fromtimestamp(int(time.time()), pytz.timezone('Asia/Shanghai'))
-            now = now.replace(tzinfo=None)
-            next4am = datetime(year=now.year, month=now.month, day=now.day, hour=4) + timedelta(days=1)
-            restart_gaps = ((next4am - now).seconds + 600 * random.random()) // self.cron_mgr.sleep_time
+            restart_gaps = self.seconds_to_restart() // self.cron_mgr.sleep_time
             self.cron_mgr.new_job(CronJob('restart', restart, restart_gaps, 180, skip_first=True))
 
         self.cron_mgr.new_job(CronJob('check_node_update', self.check_node_update, 2, 360))
+        self.cron_mgr.new_job(CronJob('check_service', self.check_service, 1, 60, in_error=report_error))
 
         self.cron_mgr.run()
 
+    def run_async(self, sync_interval: float = 60, user_interval: float = 60):
+        # same jobs as `run`, on the asyncio scheduler, sampling traffic every `sync_interval` seconds
+        # and syncing user config every `user_interval` seconds
+        cron_mgr = AsyncCronManager()
+        cron_mgr.new_job(AsyncCronJob('sync_users', self.sync_user_config, user_interval, 360,
+                                      jitter=user_interval / 10, in_error=report_error))
+        cron_mgr.new_job(AsyncCronJob('sample_traffic', self.sample_traffic, sync_interval, 360,
+                                      jitter=sync_interval / 10, in_error=report_error))
+
+        if 'restart' in self.node_obj.properties:
+            cron_mgr.new_job(AsyncCronJob('restart', restart, self.seconds_to_restart(), 180, skip_first=True))
+
+        cron_mgr.new_job(AsyncCronJob('check_node_update', self.check_node_update, 120, 360, jitter=30))
+        cron_mgr.new_job(AsyncCronJob('check_service', self.check_service, 10, 60, in_error=report_error))
+
+        cron_mgr.run()
+
     def update_traffic(self, identifier, upload=None, download=None):
         self.id2user[identifier].update_traffic(upload, download)
 
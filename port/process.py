@@ -0,0 +1,143 @@
+from typing import *
+import os
+import re
+import time
+import signal
+import subprocess
+import logging
+
+from .runtime import RuntimeAPI
+
+logger = logging.getLogger('walless')
+
+
+class HAProxyProcess:
+    """
+    HAProxy run in master-worker mode (`-W`), with the master CLI on `master_socket`.
+
+    `reload` signals the master, which starts a new worker on the regenerated config. The new worker
+    takes over the listening sockets from the old one (`expose-fd listeners` on the stats socket),
+    so no connection is refused, and the old worker keeps serving its sessions until they end.
+    Stick-table counters are handed over by the `peers` section of the config: the new worker answers
+    on the runtime API before the local peer has copied the tables of the old one into it, so `reload`
+    also waits for that resync (`show peers`), and `resynced` tells whether it is known to be over.
+    `poll` tells whether the master is still running, and `start` brings up a new one after a failure.
+    """
+
+    def __init__(self, executable: str, runtime: RuntimeAPI, config: str = './haproxy_config',
+                 master_socket: str = '/tmp/haproxy-master.sock', local_peer: str = 'walless',
+                 peers_section: str = 'local', env: Optional[Dict[str, str]] = None):
+        self.executable = executable
+        self.runtime = runtime
+        self.config = config
+        self.master_socket = master_socket
+        # name of this process in the peers section
+        self.local_peer = local_peer
+        self.peers_section = peers_section
+        # whether the tables of the running worker are complete; a new master has nothing to learn
+        self.resynced = True
+        self.env = env
+        self.proc: Optional[subprocess.Popen] = None
+        self.n_starts = 0
+        self.n_reloads = 0
+
+    @property
+    def command(self) -> List[str]:
+        return [self.executable, '-W', '-S', f'{self.master_socket},mode,600', '-L', self.local_peer, '-f', self.config]
+
+    def start(self, timeout: float = 10) -> bool:
+        # returns once the runtime API answers
+        self.proc = subprocess.Popen(self.command, env=self.env)
+        self.n_starts += 1
+        self.resynced = True
+        # the session with the worker before, if any, is gone
+        self.runtime.close()
+        since = time.time()
+        while time.time() - since < timeout:
+            if not self.poll():
+                logger.error('HAProxy exited right after it started.')
+                return False
+            if self.worker_pid() is not None:
+                return True
+            time.sleep(0.1)
+            self.runtime.close()
+        logger.error(f'The runtime API of HAProxy did not answer in {timeout}s after it started.')
+        return False
+
+    def poll(self) -> bool:
+        # whether the master is running
+        return self.proc is not None and self.proc.poll() is None
+
+    def check_config(self) -> bool:
+        ret = subprocess.run([self.executable, '-c', '-q', '-L', self.local_peer, '-f', self.config],
+                             env=self.env, stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
+        if ret.returncode != 0:
+            logger.error(f'Invalid HAProxy config: {ret.stdout.decode(errors="replace").strip()}')
+        return ret.returncode == 0
+
+    def worker_pid(self) -> Optional[int]:
+        try:
+            found = re.search(r'^Pid: (\d+)$', self.runtime.execute('show info'), re.M)
+        except (OSError, ConnectionError):
+            return None
+        return int(found.group(1)) if found else None
+
+    def check_resync(self) -> bool:
+        # whether the local peer has finished copying the tables of the old worker into the new one
+        if self.resynced:
+            return True
+        try:
+            reply = self.runtime.execute('show peers')
+        except (OSError, ConnectionError):
+            return False
+        # the line of the section, e.g. `0x55d7c1a3c8a0: [18/Oct/2026:18:10:15] id=local ... flags=0x3 ...`,
+        # where 0x1 is set once the resync from the local peer is finished or not needed
+        found = re.search(rf'\bid={re.escape(self.peers_section)}\b.*?\bflags=0x([0-9a-fA-F]+)', reply)
+        if found is None:
+            logger.warning(f'No peers section {self.peers_section} in `show peers`. Assume the tables are resynced.')
+            self.resynced = True
+        else:
+            self.resynced = bool(int(found.group(1), 16) & 0x1)
+        return self.resynced
+
+    def wait_resync(self, timeout: float) -> bool:
+        since = time.time()
+        while not self.check_resync():
+            if time.time() - since > timeout:
+                logger.error(f'The tables of the new HAProxy worker are not resynced after {timeout}s.')
+                return False
+            time.sleep(0.2)
+        logger.warning(f'The tables of the new HAProxy worker are resynced in {time.time() - since:.2f}s.')
+        return True
+
+    def reload(self, timeout: float = 10, resync_timeout: float = 30) -> bool:
+        # returns once the new worker answers on the runtime API and has the tables of the old one,
+        # or it is known not to have them (`resynced` stays False until they are)
+        if not self.poll():
+            logger.error('HAProxy is not running. Start it instead of reloading.')
+            self.start()
+            return True
+        if not self.check_config():
+            return False
+        old_pid = self.worker_pid()
+        os.kill(self.proc.pid, signal.SIGUSR2)
+        self.n_reloads += 1
+        since = time.time()
+        while time.time() - since < timeout:
+            time.sleep(0.2)
+            # reconnect: the session before belongs to the old worker
+            self.runtime.close()
+            pid = self.worker_pid()
+            if pid is not None and pid != old_pid:
+                logger.warning(f'HAProxy reloaded in {time.time() - since:.2f}s. Worker {old_pid} -> {pid}.')
+                self.resynced = False
+                self.wait_resync(resync_timeout)
+                return True
+        logger.error(f'No new HAProxy worker in {timeout}s after reloading.')
+        return False
+
+    def stop(self):
+        if self.poll():
+            self.proc.terminate()
+            self.proc.wait()
+        self.runtime.close()
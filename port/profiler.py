@@ -0,0 +1,134 @@
+from typing import *
+import os
+import sys
+import time
+import threading
+import tracemalloc
+import functools
+import logging
+from collections import Counter
+
+logger = logging.getLogger('walless')
+
+
+class StageProfiler:
+    """
+    An opt-in sampling profiler for the stages of the port service.
+
+    Functions wrapped by `wrap` mark their thread as running a stage. A background thread reads the
+    stacks of those threads every `interval` seconds through sys._current_frames, so the stages run
+    untouched between samples, and counts them as collapsed stacks (`stage;outer;...;inner count`,
+    the input of flamegraph.pl and speedscope).
+    Allocations are traced by tracemalloc with `n_frames` frames. Every stage run records the memory
+    it kept and the peak it reached (the peak is process-wide, so stages running at the same time blur it);
+    once per `dump_gap`, the next run of each stage also compares snapshots for the `top_n` lines that
+    allocated the most.
+    Every `dump_gap` seconds, both are written to `out_dir`: `<name>.collapsed` and `<name>.alloc.txt`.
+    """
+
+    def __init__(self, out_dir: str, name: str = 'walless_port_profile', interval: float = 0.01,
+                 dump_gap: float = 600, top_n: int = 20, n_frames: int = 1):
+        self.out_dir = out_dir
+        self.name = name
+        self.interval = interval
+        self.dump_gap = dump_gap
+        self.top_n = top_n
+        self.n_frames = n_frames
+        # thread id -> the stages it is in, innermost last
+        self.active: Dict[int, List[str]] = dict()
+        self.stacks: Counter = Counter()
+        self.n_samples = 0
+        # stage -> [runs, bytes kept, max peak]
+        self.alloc: Dict[str, List[int]] = dict()
+        # stage -> the top lines of its last compared run
+        self.alloc_top: Dict[str, List[str]] = dict()
+        self._compare_due: Set[str] = set()
+        self.lock = threading.Lock()
+        self._thread: Optional[threading.Thread] = None
+
+    def start(self):
+        os.makedirs(self.out_dir, exist_ok=True)
+        if not tracemalloc.is_tracing():
+            tracemalloc.start(self.n_frames)
+        self._thread = threading.Thread(target=self.loop, name='profiler', daemon=True)
+        self._thread.start()
+        logger.warning(f'Profiling every {self.interval}s into {self.out_dir}.')
+
+    def wrap(self, func: Callable, stage: str) -> Callable:
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            ident = threading.get_ident()
+            # the first run of a stage is compared as well
+            compare = stage in self._compare_due or stage not in self.alloc
+            with self.lock:
+                self.active.setdefault(ident, []).append(stage)
+                self._compare_due.discard(stage)
+            before = tracemalloc.take_snapshot() if compare else None
+            current, _ = tracemalloc.get_traced_memory()
+            tracemalloc.reset_peak()
+            try:
+                return func(*args, **kwargs)
+            finally:
+                after, peak = tracemalloc.get_traced_memory()
+                with self.lock:
+                    stages = self.active[ident]
+                    stages.pop()
+                    if not stages:
+                        del self.active[ident]
+                    stat = self.alloc.setdefault(stage, [0, 0, 0])
+                    stat[0] += 1
+                    stat[1] += after - current
+                    stat[2] = max(stat[2], peak - current)
+                if before is not None:
+                    diff = tracemalloc.take_snapshot().compare_to(before, 'lineno')
+                    self.alloc_top[stage] = [str(line) for line in diff[:self.top_n]]
+        return wrapper
+
+    def sample(self):
+        with self.lock:
+            active = {ident: list(stages) for ident, stages in self.active.items()}
+        if not active:
+            return
+        frames = sys._current_frames()
+        for ident, stages in active.items():
+            frame = frames.get(ident)
+            stack = list()
+            while frame is not None:
+                code = frame.f_code
+                stack.append(f'{os.path.basename(code.co_filename)}:{code.co_name}')
+                frame = frame.f_back
+            self.stacks[';'.join([stages[-1]] + stack[::-1])] += 1
+        self.n_samples += 1
+
+    def dump(self):
+        with self.lock:
+            stacks = list(self.stacks.items())
+            alloc = {stage: list(stat) for stage, stat in self.alloc.items()}
+            alloc_top = dict(self.alloc_top)
+            self._compare_due = set(self.alloc)
+        self._write(f'{self.name}.collapsed', ''.join(f'{stack} {n}\n' for stack, n in sorted(stacks)))
+        lines = [f'# {time.strftime("%Y-%m-%d %H:%M:%S")}, {self.n_samples} samples',
+                 f'# traced memory: {tracemalloc.get_traced_memory()[0] / 1024**2:.1f}MiB']
+        for stage, (n_runs, kept, peak) in sorted(alloc.items()):
+            lines.append(f'\n{stage}: {n_runs} runs, kept {kept / 1024**2:+.2f}MiB in total, '
+                         f'peak {peak / 1024**2:.2f}MiB above the start')
+            lines += [f'    {line}' for line in alloc_top.get(stage, [])]
+        self._write(f'{self.name}.alloc.txt', '\n'.join(lines) + '\n')
+
+    def _write(self, filename: str, content: str):
+        path = os.path.join(self.out_dir, filename)
+        with open(path + '.tmp', 'w') as fp:
+            fp.write(content)
+        os.replace(path + '.tmp', path)
+
+    def loop(self):
+        next_dump = time.time() + self.dump_gap
+        while True:
+            time.sleep(self.interval)
+            try:
+                self.sample()
+                if time.time() >= next_dump:
+                    next_dump += self.dump_gap
+                    self.dump()
+            except Exception as e:
+                logger.error(f'Error in the profiler: {e}')
@@ -0,0 +1,93 @@
+from typing import *
+import socket
+import time
+import logging
+
+from .config import is_ip
+from .runtime import RuntimeAPI, set_server_error
+
+logger = logging.getLogger('walless')
+
+
+class RelayReconciler:
+    """
+    Points relay backends at their targets through the runtime API, with no config change.
+
+    Each relay backend is configured with `n_slots` placeholder servers (`slot0`, `slot1`, ...), all
+    disabled at 0.0.0.0:1. To move a relay, the target is resolved, set into a free slot with
+    `set server ... addr`, the slot is enabled, and the slot used before is disabled: new connections
+    go to the new target, and the established ones stay where they are.
+    `applied` is what the running HAProxy has; it is cleared when HAProxy starts over.
+    """
+
+    def __init__(self, runtime: RuntimeAPI, n_slots: int = 2, dns_ttl: float = 300,
+                 resolve: Callable = socket.getaddrinfo):
+        self.runtime = runtime
+        self.n_slots = n_slots
+        self.dns_ttl = dns_ttl
+        self.resolve = resolve
+        # backend -> (slot, ip, port) of the enabled slot
+        self.applied: Dict[str, Tuple[int, str, int]] = dict()
+        # host -> (ip, time resolved)
+        self._dns: Dict[str, Tuple[str, float]] = dict()
+
+    @staticmethod
+    def slot_name(slot: int) -> str:
+        return f'slot{slot}'
+
+    def reset(self):
+        # HAProxy started over with every slot disabled
+        self.applied.clear()
+
+    def lookup(self, host: str) -> Optional[str]:
+        # IPv4 and IPv6 literals are used as they are; names may resolve to either
+        if is_ip(host):
+            return host
+        cached = self._dns.get(host)
+        if cached is not None and time.time() - cached[1] < self.dns_ttl:
+            return cached[0]
+        try:
+            ip = self.resolve(host, None, socket.AF_UNSPEC, socket.SOCK_STREAM)[0][4][0]
+        except (OSError, IndexError) as e:
+            logger.error(f'Cannot resolve relay target {host}: {e}')
+            # keep using the last known address
+            return cached[0] if cached is not None else None
+        self._dns[host] = (ip, time.time())
+        return ip
+
+    def reconcile(self, targets: Dict[str, Tuple[str, int]]) -> bool:
+        # targets: backend -> (host, port); returns whether every backend points at its target
+        commands, moves = list(), list()
+        for backend, (host, port) in targets.items():
+            ip = self.lookup(host)
+            if ip is None:
+                continue
+            current = self.applied.get(backend)
+            if current is not None and current[1:] == (ip, port):
+                continue
+            slot = 0 if current is None else (current[0] + 1) % self.n_slots
+            commands.append(f'set server {backend}/{self.slot_name(slot)} addr {ip} port {port}')
+            commands.append(f'enable server {backend}/{self.slot_name(slot)}')
+            if current is not None:
+                commands.append(f'disable server {backend}/{self.slot_name(current[0])}')
+            moves.append((backend, (slot, ip, port), current))
+        for backend in self.applied.keys() - targets.keys():
+            # the relay is gone from the node; its section is removed by the next reload
+            self.applied.pop(backend)
+        if not commands:
+            return True
+
+        errors = dict()
+        for cmd, ret in zip(commands, self.runtime.pipeline(commands)):
+            # `set server ... addr` answers with what changed; enabling and disabling answer nothing
+            error = set_server_error(ret) if cmd.startswith('set server') else ret.strip() or None
+            if error is not None:
+                errors.setdefault(cmd.split()[2].split('/')[0], error)
+        for backend, state, before in moves:
+            if backend in errors:
+                logger.error(f'Error while moving relay {backend} to {state[1]}:{state[2]}: {errors[backend]}')
+                continue
+            self.applied[backend] = state
+            logger.warning(f'Relay {backend} now goes to {state[1]}:{state[2]}'
+                           + (f' instead of {before[1]}:{before[2]}.' if before is not None else '.'))
+        return not errors
@@ -0,0 +1,222 @@
+from typing import *
+import re
+import socket
+import time
+import threading
+import logging
+
+from .metrics import REGISTRY
+
+logger = logging.getLogger('walless')
+
+CONNECTS = REGISTRY.counter('walless_runtime_connects_total', 'Connections to the HAProxy runtime API')
+ROUND_TRIPS = REGISTRY.counter('walless_runtime_round_trips_total', 'Round trips on the HAProxy runtime API')
+COMMANDS = REGISTRY.counter('walless_runtime_commands_total', 'Commands answered by the HAProxy runtime API')
+DUMP_BYTES = REGISTRY.counter('walless_table_dump_bytes_total', 'Bytes of stick-table dumps parsed')
+DUMP_ENTRIES = REGISTRY.counter('walless_table_dump_entries_total', 'Entries of stick-table dumps parsed')
+PARSE_SECONDS = REGISTRY.histogram('walless_table_parse_seconds', 'Time parsing one stick-table dump, without the wait for HAProxy',
+                                   buckets=(.001, .005, .01, .025, .05, .1, .25, .5, 1., 2.5, 5.))
+
+
+class RuntimeAPI:
+    """
+    A persistent session to the HAProxy runtime API (the stats socket) in interactive mode.
+
+    After `prompt` is sent, HAProxy terminates every reply with `\\n> ` and keeps the connection open,
+    so many commands can be written at once and the replies split on the prompt afterwards.
+    HAProxy drops the session on reload or when `stats timeout` expires; we notice it before
+    writing and reconnect, and resend whatever was not answered if it dies in the middle of a batch.
+    """
+    PROMPT = b'\n> '
+
+    def __init__(self, path: str = '/tmp/haproxy.sock', timeout: float = 30, batch_size: int = 512):
+        self.path = path
+        self.timeout = timeout
+        # number of commands written to the socket before we wait for their replies
+        self.batch_size = batch_size
+        self.recv_size = 256 * 1024
+        self.lock = threading.RLock()
+        self._sock: Optional[socket.socket] = None
+        self._buf = bytearray()
+        # statistics
+        self.n_connects = 0
+        self.n_round_trips = 0
+        self.n_commands = 0
+
+    def connect(self):
+        self.close()
+        s = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        s.settimeout(self.timeout)
+        s.connect(self.path)
+        self._sock = s
+        s.sendall(b'prompt\n')
+        # `prompt` itself answers with an empty reply
+        self._read_reply()
+        self.n_connects += 1
+        CONNECTS.inc()
+
+    def close(self):
+        if self._sock is not None:
+            try:
+                self._sock.close()
+            except OSError:
+                pass
+        self._sock = None
+        self._buf.clear()
+
+    def alive(self) -> bool:
+        if self._sock is None:
+            return False
+        # peek without blocking: EOF means HAProxy closed the session, and unread bytes
+        # mean we lost track of the replies; either way the session cannot be reused.
+        self._sock.settimeout(0)
+        try:
+            self._sock.recv(1, socket.MSG_PEEK)
+        except BlockingIOError:
+            return True
+        except OSError:
+            return False
+        finally:
+            self._sock.settimeout(self.timeout)
+        return False
+
+    def _fill(self):
+        piece = self._sock.recv(self.recv_size)
+        if not piece:
+            raise ConnectionError('HAProxy closed the runtime API session')
+        self._buf += piece
+
+    def _read_reply(self) -> bytes:
+        start = 0
+        while True:
+            idx = self._buf.find(self.PROMPT, start)
+            if idx >= 0:
+                reply = bytes(self._buf[:idx])
+                del self._buf[:idx + len(self.PROMPT)]
+                return reply
+            start = max(0, len(self._buf) - len(self.PROMPT) + 1)
+            self._fill()
+
+    def _run_batch(self, batch: List[str]) -> List[str]:
+        replies = list()
+        for trial in range(2):
+            try:
+                if not self.alive():
+                    self.connect()
+                self._sock.sendall(''.join(cmd if cmd.endswith('\n') else cmd + '\n' for cmd in batch).encode())
+                self.n_round_trips += 1
+                ROUND_TRIPS.inc()
+                for _ in batch:
+                    replies.append(self._read_reply().decode())
+                    self.n_commands += 1
+                COMMANDS.inc(len(batch))
+                return replies
+            except OSError as e:
+                self.close()
+                if trial > 0:
+                    raise
+                # commands that were answered are done; resend the rest on a fresh session
+                logger.warning(f'Runtime API session lost after {len(replies)}/{len(batch)} replies: {e}. Reconnecting.')
+                batch = batch[len(replies):]
+
+    def pipeline(self, commands: Iterable[str]) -> List[str]:
+        commands = list(commands)
+        replies = list()
+        with self.lock:
+            for i in range(0, len(commands), self.batch_size):
+                replies.extend(self._run_batch(commands[i:i + self.batch_size]))
+        return replies
+
+    def execute(self, command: str) -> str:
+        return self.pipeline([command])[0]
+
+    def stream(self, command: str) -> Iterator[bytes]:
+        """
+        Run one command and yield its reply piece by piece as it arrives, without the final prompt.
+        Meant for large replies such as `show table`. The session is locked until the generator
+        is exhausted or closed; a reply that is not read to the end costs a reconnection.
+        """
+        keep = len(self.PROMPT) - 1
+        with self.lock:
+            if not self.alive():
+                self.connect()
+            self._sock.sendall((command if command.endswith('\n') else command + '\n').encode())
+            self.n_round_trips += 1
+            ROUND_TRIPS.inc()
+            finished = False
+            try:
+                while True:
+                    idx = self._buf.find(self.PROMPT)
+                    if idx >= 0:
+                        piece = bytes(self._buf[:idx])
+                        del self._buf[:idx + len(self.PROMPT)]
+                        finished = True
+                        self.n_commands += 1
+                        COMMANDS.inc()
+                        if piece:
+                            yield piece
+                        return
+                    # hold back what could be the beginning of a prompt split across two reads
+                    if len(self._buf) > keep:
+                        piece = bytes(self._buf[:-keep])
+                        del self._buf[:-keep]
+                        yield piece
+                    self._fill()
+            finally:
+                if not finished:
+                    self.close()
+
+
+# the clauses of a successful `set server ... addr` reply
+SET_SERVER_OK = re.compile(r"^(?:(?:IP|port) changed from '[^']*' to '[^']*'|no need to change the \w+)(?: by '[^']*')?\.?$")
+
+
+def set_server_error(reply: str) -> Optional[str]:
+    """
+    The error in the reply to `set server <b>/<s> addr <ip> [port <port>]`, or None if it went through.
+    HAProxy may apply the address and refuse the port in the same reply, e.g.
+    `IP changed from ..., can't change <port> when port map is enabled`, so every clause is checked.
+    """
+    reply = reply.strip()
+    if not reply:
+        return None
+    clauses = [clause.strip() for line in reply.splitlines() for clause in line.split(', ')]
+    errors = [clause for clause in clauses if clause and not SET_SERVER_OK.match(clause)]
+    return ', '.join(errors) if errors else None
+
+
+def parse_table(chunks: Iterable[bytes], columns: Sequence[str]) -> Iterator[Tuple[int, ...]]:
+    """
+    Parse the output of `show table` for a table with integer keys, e.g.
+    `0x55d7c1a3c8a0: key=123 use=0 exp=0 shard=0 bytes_in_cnt=4567`, and yield (key, *columns).
+    `columns` must be given in the order HAProxy prints them (the order of its data types,
+    e.g. gpt0, gpc0, conn_cur, bytes_in_cnt, bytes_out_cnt), not the order in `store`.
+    Only one piece plus an incomplete line is held in memory at any time.
+    """
+    pat = re.compile(rb'key=(\d+)' + b''.join(rb'[^\n]* ' + c.encode() + rb'=(\d+)' for c in columns))
+    tail = b''
+    n_bytes = n_entries = 0
+    parse_time = 0.
+
+    def parse(block):
+        nonlocal n_bytes, n_entries, parse_time
+        since = time.perf_counter()
+        rows = [tuple(map(int, groups)) for groups in pat.findall(block)]
+        parse_time += time.perf_counter() - since
+        n_bytes += len(block)
+        n_entries += len(rows)
+        return rows
+
+    for chunk in chunks:
+        end = chunk.rfind(b'\n')
+        if end < 0:
+            tail += chunk
+            continue
+        block = tail + chunk[:end] if tail else chunk[:end]
+        tail = chunk[end + 1:]
+        yield from parse(block)
+    yield from parse(tail)
+    # a dump not read to the end is not counted
+    DUMP_BYTES.inc(n_bytes)
+    DUMP_ENTRIES.inc(n_entries)
+    PARSE_SECONDS.observe(parse_time)
@@ -0,0 +1,71 @@
+from typing import *
+import os
+import time
+import logging
+
+logger = logging.getLogger('walless')
+
+
+def snapshot_path(root: Optional[str] = None) -> str:
+    root = root if root is not None else os.environ.get('WALLESS_ROOT', os.environ.get('HOME'))
+    return os.path.join(root, '.var', 'port_snapshot')
+
+
+class SnapshotUser(NamedTuple):
+    # stands in for a walless_utils.User restored from a snapshot, until the user is fetched again
+    user_id: int
+    uuid: str
+
+
+class SnapshotEntry(NamedTuple):
+    user_id: int
+    uuid: str
+    map_key: str
+    # last reported upload and download
+    last_up: int
+    last_down: int
+
+
+class Snapshot:
+    """
+    The last known users of this node on disk: user id, uuid, map key, and last reported traffic,
+    one user per line. It lets the service start HAProxy with a full user map right away and
+    reconcile with the database afterwards. The header holds the time it was saved and the epoch
+    of the traffic tables the counters were read from.
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        # epoch of the traffic tables, as of the last load
+        self.epoch: Optional[int] = None
+
+    def exists(self) -> bool:
+        return os.path.exists(self.path)
+
+    def save(self, entries: Iterable[SnapshotEntry], epoch: Optional[int] = None):
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        tmp_path = self.path + '.tmp'
+        # the uuids are the credentials of the users: only the owner may read them
+        fd = os.open(tmp_path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+        os.fchmod(fd, 0o600)
+        with open(fd, 'w') as fp:
+            fp.write(f'# {int(time.time())} {epoch}\n')
+            fp.writelines(' '.join(map(str, entry)) + '\n' for entry in entries)
+        os.replace(tmp_path, self.path)
+
+    def load(self) -> List[SnapshotEntry]:
+        if not self.exists():
+            return list()
+        ret = list()
+        with open(self.path) as fp:
+            for line in fp:
+                fields = line.split()
+                if line.startswith('#'):
+                    if len(fields) == 3 and fields[2].isdigit():
+                        self.epoch = int(fields[2])
+                    continue
+                if len(fields) != 5:
+                    continue
+                user_id, uuid, map_key, last_up, last_down = fields
+                ret.append(SnapshotEntry(int(user_id), uuid, map_key, int(last_up), int(last_down)))
+        return ret
@@ -0,0 +1,86 @@
+from typing import *
+import os
+import threading
+import logging
+
+logger = logging.getLogger('walless')
+
+
+class TrafficSpool:
+    """
+    An append-only log of traffic deltas on disk, so that they survive a slow or unreachable
+    database and restarts of the service.
+
+    Deltas go to segment files `<seq>.log` under `path`, one `user_id node_uuid upload download ts` per line.
+    `append` writes the rows of a round and fsyncs once. The segment being written is sealed when it
+    grows above `segment_size` or when the drainer asks for it; only sealed segments are read and deleted.
+    Segments left by an earlier run are sealed ones.
+    """
+
+    def __init__(self, path: str, segment_size: int = 4 * 1024**2):
+        self.path = path
+        self.segment_size = segment_size
+        self.lock = threading.Lock()
+        os.makedirs(path, exist_ok=True)
+        seqs = [int(fn[:-4]) for fn in os.listdir(path) if fn.endswith('.log') and fn[:-4].isdigit()]
+        self.seq = max(seqs, default=0) + 1
+        self._fp = None
+
+    def _segment(self, seq: int) -> str:
+        return os.path.join(self.path, f'{seq:012d}.log')
+
+    def append(self, rows: List[tuple]):
+        with self.lock:
+            if self._fp is None:
+                self._fp = open(self._segment(self.seq), 'a')
+            self._fp.write(''.join(' '.join(map(str, row)) + '\n' for row in rows))
+            self._fp.flush()
+            os.fsync(self._fp.fileno())
+            if self._fp.tell() > self.segment_size:
+                self._seal()
+
+    def _seal(self):
+        if self._fp is not None:
+            self._fp.close()
+            self._fp = None
+            self.seq += 1
+
+    def seal(self):
+        with self.lock:
+            self._seal()
+
+    def sealed(self) -> List[str]:
+        with self.lock:
+            current = self._segment(self.seq)
+        return sorted(
+            os.path.join(self.path, fn) for fn in os.listdir(self.path)
+            if fn.endswith('.log') and os.path.join(self.path, fn) != current
+        )
+
+    @staticmethod
+    def read(segments: List[str]) -> List[tuple]:
+        # entries of the same user and node are merged: deltas are summed and the latest time is kept
+        merged: Dict[Tuple[int, str], List[int]] = dict()
+        for segment in segments:
+            with open(segment) as fp:
+                for line in fp:
+                    fields = line.split()
+                    if len(fields) != 5:
+                        # a line cut short by a crash
+                        logger.warning(f'Skip a broken line in {segment}: {line.strip()}')
+                        continue
+                    user_id, node_uuid, upload, download, ts = fields
+                    entry = merged.setdefault((int(user_id), node_uuid), [0, 0, 0])
+                    entry[0] += int(upload)
+                    entry[1] += int(download)
+                    entry[2] = max(entry[2], int(ts))
+        return [(user_id, node_uuid, upload, download, ts) for (user_id, node_uuid), (upload, download, ts) in merged.items()]
+
+    @staticmethod
+    def remove(segments: List[str]):
+        for segment in segments:
+            os.remove(segment)
+
+    def backlog(self) -> int:
+        # bytes waiting to be uploaded
+        return sum(os.path.getsize(os.path.join(self.path, fn)) for fn in os.listdir(self.path) if fn.endswith('.log'))
@@ -0,0 +1,182 @@
+from typing import *
+import time
+import logging
+from threading import Thread, Event
+
+from walless_utils import db, EditReservior
+
+from .spool import TrafficSpool
+from .utils import report_error
+from .metrics import REGISTRY
+
+logger = logging.getLogger('walless')
+
+UPLOAD_ROWS = REGISTRY.counter('walless_upload_rows_total', 'Traffic logs written to the database')
+UPLOAD_ERRORS = REGISTRY.counter('walless_upload_errors_total', 'Failed uploads of traffic logs')
+FLUSH_SECONDS = REGISTRY.histogram('walless_upload_flush_seconds', 'Time of writing a batch of traffic logs to the database')
+SPOOLED_ROWS = REGISTRY.counter('walless_spool_rows_total', 'Traffic logs appended to the spool')
+SPOOL_BACKLOG = REGISTRY.gauge('walless_spool_backlog_bytes', 'Bytes in the spool waiting to be uploaded')
+
+
+class TrafficUploader:
+    """
+    Writes traffic logs through a writer that lives as long as the service.
+
+    With `connect`, a function returning a DB-API connection (pymysql, sqlite3, ...), the connection
+    is kept open between rounds and reopened after an error. `sql` is the single-row insert in the
+    paramstyle of that driver, e.g. `INSERT INTO log VALUES (%s, %s, %s, %s, %s)`; with `multi_row`,
+    each batch of `batch_size` rows is sent as one `INSERT ... VALUES (...), (...), ...`, otherwise
+    with `executemany`. Without `connect`, one EditReservior on walless_utils' db is reused.
+    Either way, the rows of one `write` are committed at once: a write that fails leaves none of them
+    in the database, so that retrying it does not count any twice.
+    """
+
+    def __init__(self, sql: Optional[str] = None, connect: Optional[Callable] = None,
+                 batch_size: int = 1024, multi_row: bool = True):
+        self.sql = sql if sql is not None else db.upload_log_sql
+        self.connect = connect
+        self.batch_size = batch_size
+        self.multi_row = multi_row
+        self._conn = None
+        self._editor: Optional[EditReservior] = None
+        # rows the reservoir holds before it writes them out by itself
+        self._editor_size = 0
+        # statistics
+        self.n_rows = 0
+        self.n_flushes = 0
+        self.flush_time = 0.
+        self.last_flush_time = 0.
+
+    def _multi_row_sql(self, n: int) -> str:
+        head, values = self.sql.rsplit('VALUES', 1)
+        return head + 'VALUES ' + ', '.join([values.strip()] * n)
+
+    def _write_db_api(self, rows: List[tuple]):
+        if self._conn is None:
+            self._conn = self.connect()
+        try:
+            cursor = self._conn.cursor()
+            for i in range(0, len(rows), self.batch_size):
+                batch = rows[i:i + self.batch_size]
+                if self.multi_row:
+                    cursor.execute(self._multi_row_sql(len(batch)), [x for row in batch for x in row])
+                else:
+                    cursor.executemany(self.sql, batch)
+            self._conn.commit()
+            cursor.close()
+        except Exception:
+            # the connection may be broken; start over with a new one next time
+            try:
+                self._conn.close()
+            except Exception:
+                pass
+            self._conn = None
+            raise
+
+    def write(self, rows: List[tuple]):
+        since = time.time()
+        if self.connect is not None:
+            self._write_db_api(rows)
+        else:
+            if self._editor is None or self._editor_size <= len(rows):
+                # room for every row, so that they go out in the single flush below: a reservoir that
+                # fills up flushes by itself, and a failure after that would leave part of the rows written
+                self._editor_size = max(self.batch_size, len(rows) + 1)
+                self._editor = EditReservior(sql=self.sql, db=db, block=True, cache_size=self._editor_size)
+            try:
+                for row in rows:
+                    self._editor.add(row)
+                self._editor.flush()
+            except Exception:
+                # do not let rows of a failed flush linger in the reservoir
+                self._editor = None
+                raise
+        self.last_flush_time = time.time() - since
+        self.flush_time += self.last_flush_time
+        self.n_flushes += 1
+        self.n_rows += len(rows)
+        UPLOAD_ROWS.inc(len(rows))
+        FLUSH_SECONDS.observe(self.last_flush_time)
+
+    @property
+    def rows_per_sec(self) -> float:
+        return self.n_rows / self.flush_time if self.flush_time > 0 else 0.
+
+    def __str__(self):
+        return f'{self.n_rows} rows in {self.n_flushes} flushes, {self.rows_per_sec:.0f} rows/sec, ' \
+               f'last flush {self.last_flush_time:.3f}s'
+
+
+class TrafficWriter:
+    """
+    Hands traffic logs over to the database on a background thread, so that sampling never waits for it.
+
+    `submit` appends the rows of a round to the on-disk spool and returns once they are fsynced, after
+    which the caller may reset its deltas. The drainer thread seals the segment being written, merges
+    the rows of the sealed segments per user, uploads them, and deletes the segments. If the upload
+    fails, the segments stay and are retried with a growing delay, so rows are neither lost nor
+    blocking while the database is away, and whatever is left is uploaded after a restart.
+    Each upload is one transaction; its rows are only uploaded twice if the service dies between the
+    commit and the removal of the segments.
+    """
+
+    def __init__(self, spool: TrafficSpool, uploader: Optional[TrafficUploader] = None, max_segments: int = 64):
+        self.spool = spool
+        self.uploader = uploader if uploader is not None else TrafficUploader()
+        # segments merged into one upload
+        self.max_segments = max_segments
+        self.event = Event()
+        self.stopped = False
+        self._thread: Optional[Thread] = None
+
+    def submit(self, rows: List[tuple]) -> bool:
+        if self._thread is None:
+            self._thread = Thread(target=self.loop, name='traffic_writer', daemon=True)
+            self._thread.start()
+        try:
+            self.spool.append(rows)
+        except OSError as e:
+            logger.error(f'Cannot spool {len(rows)} traffic logs: {e}. Keep the deltas for the next round.')
+            return False
+        SPOOLED_ROWS.inc(len(rows))
+        self.event.set()
+        return True
+
+    def drain(self):
+        self.spool.seal()
+        while True:
+            segments = self.spool.sealed()[:self.max_segments]
+            if not segments:
+                return
+            rows = self.spool.read(segments)
+            self.uploader.write(rows)
+            self.spool.remove(segments)
+            logger.info(f'Uploaded {len(rows)} traffic logs from {len(segments)} segments. Uploader: {self.uploader}.')
+
+    def stop(self, timeout: float = 60):
+        # lets the upload in progress finish; another writer on the same spool must not drain it meanwhile
+        self.stopped = True
+        self.event.set()
+        if self._thread is not None:
+            self._thread.join(timeout)
+            if self._thread.is_alive():
+                logger.error(f'The traffic writer is still uploading after {timeout}s.')
+        self.spool.seal()
+
+    def loop(self):
+        retry_gap = 0
+        while not self.stopped:
+            self.event.wait(retry_gap if retry_gap > 0 else None)
+            self.event.clear()
+            if self.stopped:
+                return
+            try:
+                self.drain()
+                retry_gap = 0
+            except Exception as e:
+                UPLOAD_ERRORS.inc()
+                retry_gap = min(max(retry_gap * 2, 10), 300)
+                logger.error(f'Error while uploading traffic logs: {e}. '
+                             f'{self.spool.backlog()} bytes spooled. Retry in {retry_gap}s.')
+                report_error()
+            SPOOL_BACKLOG.set(self.spool.backlog())
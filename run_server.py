@@ -6,6 +6,9 @@ import traceback
 
 from walless_utils import setup_everything, logger_setup, whoami
 from port.haproxy import HAProxy
+from port.snapshot import snapshot_path
+from port.metrics import serve_metrics
+from port.profiler import StageProfiler
 from walless_utils.network_status import NetworkStatus
 
 logger = logging.getLogger('walless')
@@ -14,19 +17,48 @@ logger = logging.getLogger('walless')
 def run():
     parser = ArgumentParser()
     parser.add_argument('--debug', action='store_true')
+    parser.add_argument('--aio', action='store_true', help='use the asyncio scheduler')
+    parser.add_argument('--sync-interval', type=float, default=60, help='seconds between two traffic samples (with --aio)')
+    parser.add_argument('--user-interval', type=float, default=60, help='seconds between two user config syncs (with --aio)')
+    parser.add_argument('--cold-start', action='store_true', help='pull all users before starting, even if there is a snapshot')
+    parser.add_argument('--metrics', default=None,
+                        help='serve metrics in the Prometheus text format at a Unix socket path or host:port')
+    parser.add_argument('--profile', action='store_true',
+                        help='sample the stacks and allocations of the sync stages into ~/.var/log')
+    parser.add_argument('--profile-interval', type=float, default=0.01, help='seconds between two stack samples (with --profile)')
     args = parser.parse_args()
     logger_setup(log_paths=[os.path.expanduser('~/.var/log/walless_port.log')])
     if args.debug:
         logger.setLevel('DEBUG')
+    profiler = None
+    if args.profile:
+        profiler = StageProfiler(os.path.expanduser('~/.var/log'), interval=args.profile_interval)
+        profiler.start()
+    if args.metrics is not None:
+        serve_metrics(args.metrics)
+        logger.warning(f'Serving metrics at {args.metrics}.')
 
-    logger.warning('Server started. Pulling everything.')
+    # With a snapshot of the last run, HAProxy starts with its users, and users are pulled by the first user sync
+    warm_start = not args.cold_start and os.path.exists(snapshot_path())
+    pull_users = None
+    if warm_start:
+        logger.warning('Server started. Pulling nodes; users will be pulled in the background.')
+        pull_users = lambda: setup_everything(pull_node=False, pull_user=True)
+    else:
+        logger.warning('Server started. Pulling everything.')
     since = time.time()
-    setup_everything(pull_node=True, pull_user=True)
+    setup_everything(pull_node=True, pull_user=not warm_start)
     logger.warning('Pulling finished. Time cost: %.2fs.', time.time() - since)
 
     ns = NetworkStatus()
     ns.wait_for_network()
 
+    def pull_node():
+        # this node with its relays as they are in the database now
+        setup_everything(pull_node=True, pull_user=False)
+        return whoami(ns=ns, debug=args.debug)
+
+    job = None
     while True:
         try:
             me = whoami(ns=ns, debug=args.debug)
@@ -36,8 +68,16 @@ def run():
                 time.sleep(sleep_time)
                 continue
             logger.warning(f'I am {me.name} with IP {me.ip(4)}. My tags are: {me.tag}.')
-            job = HAProxy(me, network_status=ns)
-            job.run()
+            if job is not None:
+                # the HAProxy of the last attempt still holds the ports and the stats socket
+                job.stop()
+            job = HAProxy(me, network_status=ns, pull_users=pull_users, pull_node=pull_node)
+            if profiler is not None:
+                job.enable_profiling(profiler)
+            if args.aio:
+                job.run_async(args.sync_interval, args.user_interval)
+            else:
+                job.run()
         except KeyboardInterrupt:
             logger.warning('KeyboardInterrupt. Exiting.')
             return
@@ -2,7 +2,6 @@
 import requests
 import socket
 import time
-import timeit
 import re
 import os
 import sys
@@ -10,8 +9,101 @@ import json
 import subprocess
 import threading
 import datetime
+import asyncio
+from collections import deque
 
 from walless_utils import cfg, setup_everything, whoami
+from status_protocol import CompactEncoder, COMPACT_REQUEST, COMPACT_REPLY
+
+
+class Prober:
+    """
+    Measures TCP connect time to every target once per `interval`, all from one asyncio loop on one
+    thread. Host names are resolved once per `dns_ttl`. The last `window` samples of each target
+    (the latency in ms, or None if lost) are kept for the loss rate and the latency percentiles.
+    It also checks every 10s whether IPv4 and IPv6 reach the Internet.
+    """
+
+    def __init__(self, targets, interval=1, timeout=1, window=3600, dns_ttl=300):
+        # mark -> (host, port)
+        self.targets = targets
+        self.interval = interval
+        self.timeout = timeout
+        self.dns_ttl = dns_ttl
+        self.samples = {mark: deque(maxlen=window) for mark in targets}
+        # the latency of the last probe that got through
+        self.last_latency = {mark: 0 for mark in targets}
+        self.online = {4: False, 6: False}
+        # (host, family) -> (ip, time resolved)
+        self._dns = {}
+
+    async def resolve(self, host, family=socket.AF_UNSPEC):
+        cached = self._dns.get((host, family))
+        if cached is not None and time.time() - cached[1] < self.dns_ttl:
+            return cached[0]
+        try:
+            infos = await asyncio.wait_for(
+                asyncio.get_running_loop().getaddrinfo(host, None, family=family, type=socket.SOCK_STREAM), 5)
+        except (OSError, asyncio.TimeoutError):
+            if cached is not None:
+                # keep using the last known address
+                return cached[0]
+            raise
+        self._dns[(host, family)] = (infos[0][4][0], time.time())
+        return infos[0][4][0]
+
+    async def probe(self, host, port, family=socket.AF_UNSPEC, timeout=None):
+        # connect time in ms, or None if it failed
+        try:
+            ip = await self.resolve(host, family)
+            since = time.perf_counter()
+            _, writer = await asyncio.wait_for(asyncio.open_connection(ip, port), timeout or self.timeout)
+            latency = (time.perf_counter() - since) * 1000
+            writer.close()
+            return latency
+        except (OSError, asyncio.TimeoutError):
+            return None
+
+    async def _probe_loop(self, mark, host, port):
+        loop = asyncio.get_running_loop()
+        next_probe = loop.time()
+        while True:
+            latency = await self.probe(host, port)
+            self.samples[mark].append(latency)
+            if latency is not None:
+                self.last_latency[mark] = int(latency)
+            next_probe += self.interval
+            await asyncio.sleep(max(next_probe - loop.time(), 0))
+
+    async def _online_loop(self):
+        while True:
+            for ip_version, family in [(4, socket.AF_INET), (6, socket.AF_INET6)]:
+                latency = await self.probe(f'ipv{ip_version}.google.com', 80, family, timeout=2)
+                self.online[ip_version] = latency is not None
+            await asyncio.sleep(10)
+
+    async def main(self):
+        await asyncio.gather(self._online_loop(), *(
+            self._probe_loop(mark, host, port) for mark, (host, port) in self.targets.items()
+        ))
+
+    def start(self):
+        threading.Thread(target=asyncio.run, args=(self.main(),), daemon=True).start()
+
+    def loss_rate(self, mark):
+        samples = list(self.samples[mark])
+        return sum(latency is None for latency in samples) / len(samples) if samples else 0.0
+
+    def reachable(self, mark):
+        # whether the last probe got through
+        samples = self.samples[mark]
+        return not samples or samples[-1] is not None
+
+    def percentiles(self, mark, qs=(50, 95, 99)):
+        latencies = sorted(latency for latency in list(self.samples[mark]) if latency is not None)
+        if not latencies:
+            return [0] * len(qs)
+        return [int(latencies[min(len(latencies) - 1, len(latencies) * q // 100)]) for q in qs]
 
 
 class StatusClient:
@@ -28,6 +120,10 @@ class StatusClient:
         self.port = monitor_cfg.get('port', 35601)
         self.interval = 1
         self.probeport = 80
+        # seconds between two samples; with the compact protocol, `samples_per_frame` samples are sent at once
+        self.sample_interval = monitor_cfg.get('sample_interval', self.interval)
+        self.compact = monitor_cfg.get('compact', False)
+        self.samples_per_frame = monitor_cfg.get('samples_per_frame', 1)
 
         self.edu = cfg.get('edu', 'cernet.191110.xyz')
         self.cu = cfg.get('cu', "111.205.231.10")
@@ -35,19 +131,24 @@ class StatusClient:
         self.cm = cfg.get('cm', "bj.10086.cn")
 
         self.error_state = 0
-
-        self.lostRate = {
-            '10010': 0.0,
-            '189': 0.0,
-            '10086': 0.0,
-            'edu': 0.0,
-        }
-        self.pingTime = {
-            '10010': 0,
-            '189': 0,
-            '10086': 0,
-            'edu': 0,
+        # vnstat is run at most once every `vnstat_interval` seconds; time and result of the last run
+        self.vnstat_interval = 60
+        self.vnstat_cache = [0.0, (0, 0)]
+        # the /proc/stat times of the last CPU sample
+        self.cpu_times = None
+
+        # the carriers, and more targets as `mark: host[:port]` under `probes` in the status config
+        self.carriers = ['10010', '189', '10086', 'edu']
+        probe_targets = {
+            '10010': (self.cu, self.probeport),
+            '189': (self.ct, self.probeport),
+            '10086': (self.cm, self.probeport),
+            'edu': (self.edu, self.probeport),
         }
+        for mark, target in monitor_cfg.get('probes', {}).items():
+            host, _, port = str(target).partition(':')
+            probe_targets[str(mark)] = (host, int(port) if port else self.probeport)
+        self.prober = Prober(probe_targets, self.interval)
         self.netSpeed = {
             'netrx': 0.0,
             'nettx': 0.0,
@@ -80,13 +181,52 @@ class StatusClient:
         SwapFree = float(result['SwapFree'])
         return int(MemTotal), int(MemUsed), int(SwapTotal), int(SwapFree)
 
+    HDD_FS_TYPES = {'ext4', 'ext3', 'ext2', 'reiserfs', 'jfs', 'ntfs', 'fat32', 'btrfs', 'fuseblk', 'zfs', 'simfs', 'xfs'}
+
     @staticmethod
     def get_hdd():
-        p = subprocess.check_output(['df', '-Tlm', '--total', '-t', 'ext4', '-t', 'ext3', '-t', 'ext2', '-t', 'reiserfs', '-t', 'jfs', '-t', 'ntfs', '-t', 'fat32', '-t', 'btrfs', '-t', 'fuseblk', '-t', 'zfs', '-t', 'simfs', '-t', 'xfs']).decode("Utf-8")
-        total = p.splitlines()[-1]
-        used = total.split()[3]
-        size = total.split()[2]
-        return int(size), int(used)
+        # total size and usage in MiB of the local disks, as `df -Tlm --total -t ...` reports
+        size = used = 0
+        devices = set()
+        with open('/proc/mounts') as f:
+            for line in f:
+                device, mount_point, fs_type = line.split()[:3]
+                if fs_type not in StatusClient.HDD_FS_TYPES or device in devices:
+                    continue
+                devices.add(device)
+                try:
+                    st = os.statvfs(mount_point.replace('\\040', ' '))
+                except OSError:
+                    continue
+                size += st.f_blocks * st.f_frsize
+                used += (st.f_blocks - st.f_bfree) * st.f_frsize
+        return size // 1024**2, used // 1024**2
+
+    @staticmethod
+    def count_sockets():
+        # TCP (all but listening ones, approximately) and UDP sockets in use, from the kernel's counters
+        # instead of listing every socket as `ss -nt` and `ss -nu` do
+        counts = dict()
+        for path in ['/proc/net/sockstat', '/proc/net/sockstat6']:
+            try:
+                with open(path) as f:
+                    for line in f:
+                        proto, _, fields = line.partition(':')
+                        fields = fields.split()
+                        counts[proto] = dict(zip(fields[::2], map(int, fields[1::2])))
+            except OSError:
+                pass
+        tcp = sum(counts.get(proto, {}).get(k, 0) for proto, k in [('TCP', 'inuse'), ('TCP', 'tw'), ('TCP6', 'inuse')])
+        udp = sum(counts.get(proto, {}).get('inuse', 0) for proto in ['UDP', 'UDP6'])
+        return tcp, udp
+
+    @staticmethod
+    def count_tasks():
+        # processes are the numeric entries of /proc; threads are the scheduling entities in /proc/loadavg
+        processes = sum(1 for name in os.listdir('/proc') if name.isdigit())
+        with open('/proc/loadavg') as f:
+            threads = int(f.read().split()[3].split('/')[1])
+        return processes, threads
 
     @staticmethod
     def get_time():
@@ -96,16 +236,12 @@ class StatusClient:
                 time_list[i] = int(time_list[i])
             return time_list
 
-    def delta_time(self):
-        x = self.get_time()
-        time.sleep(self.interval)
-        y = self.get_time()
-        for i in range(len(x)):
-            y[i] -= x[i]
-        return y
-
     def get_cpu(self):
-        t = self.delta_time()
+        # usage since the last call; the first call has nothing to compare with
+        x, self.cpu_times = self.cpu_times, self.get_time()
+        if x is None:
+            return 0.0
+        t = [y - x for x, y in zip(x, self.cpu_times)]
         st = sum(t)
         if st == 0:
             st = 1
@@ -113,6 +249,8 @@ class StatusClient:
         return round(result, 1)
 
     def traffic(self):
+        if time.time() - self.vnstat_cache[0] < self.vnstat_interval:
+            return self.vnstat_cache[1]
         NET_IN = 0
         NET_OUT = 0
         try:
@@ -141,14 +279,13 @@ class StatusClient:
                         self.error_state = 0
         except:
             NET_IN = NET_OUT = 0
+        self.vnstat_cache = [time.time(), (NET_IN, NET_OUT)]
         return NET_IN, NET_OUT
 
     def tupd(self):
         '''
         Hacked to return active user count
         '''
-        s = subprocess.check_output("ss -nt|wc -l", shell=True)
-        u = int(s[:-1])-1
         # active user count
         n_active = -1
         if self.error_state == -2:
@@ -167,133 +304,41 @@ class StatusClient:
             print('out of patience; rebooting in 16 sec.')
             time.sleep(16)
             os.system('/usr/bin/rebot')
-        s = subprocess.check_output("ss -nu|wc -l", shell=True)
-        u = int(s[:-1])-1 + u
-        s = subprocess.check_output("ps -ef|wc -l", shell=True)
-        p = int(s[:-1])-2
-        s = subprocess.check_output("ps -eLf|wc -l", shell=True)
-        d = int(s[:-1])-2
-        return n_active,u,p,d
+        tcp, udp = self.count_sockets()
+        p, d = self.count_tasks()
+        return n_active, tcp + udp, p, d
 
     def ip_status(self):
-        ip_check = 0
-        for i in [self.edu, self.cu, self.ct, self.cm]:
-            try:
-                socket.create_connection((i, self.probeport), timeout=1).close()
-            except:
-                ip_check += 1
+        # from the last probes to the carriers
+        ip_check = sum(not self.prober.reachable(mark) for mark in self.carriers)
         if ip_check >= 3:
             return False
         else:
             return True
 
-    def get_network(self, ip_version):
-        if(ip_version == 4):
-            HOST = "ipv4.google.com"
-        elif(ip_version == 6):
-            HOST = "ipv6.google.com"
-        try:
-            socket.create_connection((HOST, 80), 2).close()
-            return True
-        except:
-            return False
-
-    def _ping_thread(self, host, mark, port):
-        lostPacket = 0
-        allPacket = 0
-        startTime = time.time()
-
-        while True:
-            try:
-                b = timeit.default_timer()
-                socket.create_connection((host, port), timeout=1).close()
-                self.pingTime[mark] = int((timeit.default_timer()-b)*1000)
-            except:
-                lostPacket += 1
-            finally:
-                allPacket += 1
-
-            if allPacket > 100:
-                self.lostRate[mark] = float(lostPacket) / allPacket
-
-            endTime = time.time()
-            if endTime - startTime > 3600:
-                lostPacket = 0
-                allPacket = 0
-                startTime = endTime
-
-            time.sleep(self.interval)
-
-    def _net_speed(self):
-        while True:
-            with open("/proc/net/dev", "r") as f:
-                net_dev = f.readlines()
-                avgrx = 0
-                avgtx = 0
-                for dev in net_dev[2:]:
-                    dev = dev.split(':')
-                    if "lo" in dev[0] or "tun" in dev[0] \
-                            or "docker" in dev[0] or "veth" in dev[0] \
-                            or "br-" in dev[0] or "vmbr" in dev[0] \
-                            or "vnet" in dev[0] or "kube" in dev[0]:
-                        continue
-                    dev = dev[1].split()
-                    avgrx += int(dev[0])
-                    avgtx += int(dev[8])
-                now_clock = time.time()
-                self.netSpeed["diff"] = now_clock - self.netSpeed["clock"]
-                self.netSpeed["clock"] = now_clock
-                self.netSpeed["netrx"] = int((avgrx - self.netSpeed["avgrx"]) / self.netSpeed["diff"])
-                self.netSpeed["nettx"] = int((avgtx - self.netSpeed["avgtx"]) / self.netSpeed["diff"])
-                self.netSpeed["avgrx"] = avgrx
-                self.netSpeed["avgtx"] = avgtx
-            time.sleep(self.interval)
-
-    def get_realtime_date(self):
-        t1 = threading.Thread(
-            target=self._ping_thread,
-            kwargs={
-                'host': self.cu,
-                'mark': '10010',
-                'port': self.probeport
-            },
-            daemon=True,
-        )
-        t2 = threading.Thread(
-            target=self._ping_thread,
-            kwargs={
-                'host': self.ct,
-                'mark': '189',
-                'port': self.probeport
-            },
-            daemon=True,
-        )
-        t3 = threading.Thread(
-            target=self._ping_thread,
-            kwargs={
-                'host': self.cm,
-                'mark': '10086',
-                'port': self.probeport,
-            },
-            daemon=True,
-        )
-        t5 = threading.Thread(
-            target=self._ping_thread,
-            kwargs={
-                'host': self.edu,
-                'mark': 'edu',
-                'port': self.probeport
-            },
-            daemon=True,
-        )
-        t4 = threading.Thread(
-            target=self._net_speed,
-        )
-        t1.start()
-        t2.start()
-        t3.start()
-        t4.start()
-        t5.start()
+    def update_net_speed(self):
+        # rates since the last call, called once per report
+        with open("/proc/net/dev", "r") as f:
+            net_dev = f.readlines()
+            avgrx = 0
+            avgtx = 0
+            for dev in net_dev[2:]:
+                dev = dev.split(':')
+                if "lo" in dev[0] or "tun" in dev[0] \
+                        or "docker" in dev[0] or "veth" in dev[0] \
+                        or "br-" in dev[0] or "vmbr" in dev[0] \
+                        or "vnet" in dev[0] or "kube" in dev[0]:
+                    continue
+                dev = dev[1].split()
+                avgrx += int(dev[0])
+                avgtx += int(dev[8])
+            now_clock = time.time()
+            self.netSpeed["diff"] = now_clock - self.netSpeed["clock"]
+            self.netSpeed["clock"] = now_clock
+            self.netSpeed["netrx"] = int((avgrx - self.netSpeed["avgrx"]) / self.netSpeed["diff"])
+            self.netSpeed["nettx"] = int((avgtx - self.netSpeed["avgtx"]) / self.netSpeed["diff"])
+            self.netSpeed["avgrx"] = avgrx
+            self.netSpeed["avgtx"] = avgtx
 
     def byte_str(self, object):
         '''
@@ -306,9 +351,23 @@ class StatusClient:
         else:
             print(type(object))
 
+    def negotiate_compact(self, s):
+        # whether the server takes the compact protocol; a server that does not know it may not answer at all
+        s.send(self.byte_str(COMPACT_REQUEST))
+        s.settimeout(2)
+        try:
+            return self.byte_str(s.recv(1024)) == COMPACT_REPLY
+        except socket.timeout:
+            return False
+        finally:
+            s.settimeout(30)
+
     def run(self):
         socket.setdefaulttimeout(30)
-        self.get_realtime_date()
+        self.prober.start()
+        # the counters the rates are computed from
+        self.get_cpu()
+        self.update_net_speed()
         while True:
             try:
                 print("Connecting...")
@@ -339,8 +398,24 @@ class StatusClient:
                     print(data)
                     raise socket.error
 
+                encoder = None
+                if self.compact and self.negotiate_compact(s):
+                    encoder = CompactEncoder()
+                    print('Compact mode on.')
+                batch = []
+
+                # reports go out at a fixed rate: the time spent on a sample is not added to the interval
+                next_report = time.monotonic()
                 while True:
+                    next_report += self.sample_interval
+                    delay = next_report - time.monotonic()
+                    if delay > 0:
+                        time.sleep(delay)
+                    elif delay < -self.sample_interval:
+                        # more than a report behind; start over from now instead of sending a burst
+                        next_report = time.monotonic()
                     CPU = self.get_cpu()
+                    self.update_net_speed()
                     NET_IN, NET_OUT = self.traffic()
                     Uptime = self.get_uptime()
                     Load_1, Load_5, Load_15 = os.getloadavg()
@@ -349,11 +424,11 @@ class StatusClient:
                     IP_STATUS = self.ip_status()
 
                     array = {}
-                    if not timer:
-                        array['online' + str(check_ip)] = self.get_network(check_ip)
+                    if timer <= 0:
+                        array['online' + str(check_ip)] = self.prober.online[check_ip]
                         timer = 10
                     else:
-                        timer -= 1*self.interval
+                        timer -= 1*self.sample_interval
 
                     array['uptime'] = Uptime
                     array['load_1'] = Load_1
@@ -371,17 +446,20 @@ class StatusClient:
                     array['network_in'] = NET_IN
                     array['network_out'] = NET_OUT
                     array['ip_status'] = IP_STATUS
-                    array['ping_10010'] = self.lostRate.get('10010') * 100
-                    array['ping_189'] = self.lostRate.get('189') * 100
-                    array['ping_10086'] = self.lostRate.get('10086') * 100
-                    array['ping_edu'] = self.lostRate.get('edu') * 100
-                    array['time_10010'] = self.pingTime.get('10010')
-                    array['time_189'] = self.pingTime.get('189')
-                    array['time_10086'] = self.pingTime.get('10086')
-                    array['time_edu'] = self.pingTime.get('edu')
+                    for mark in self.prober.targets:
+                        array['ping_' + mark] = self.prober.loss_rate(mark) * 100
+                        array['time_' + mark] = self.prober.last_latency[mark]
+                        array['time_%s_p50' % mark], array['time_%s_p95' % mark], array['time_%s_p99' % mark] = \
+                            self.prober.percentiles(mark)
                     array['tcp'], array['udp'], array['process'], array['thread'] = self.tupd()
 
-                    s.send(self.byte_str("update " + json.dumps(array) + "\n"))
+                    if encoder is None:
+                        s.send(self.byte_str("update " + json.dumps(array) + "\n"))
+                    else:
+                        batch.append(array)
+                        if len(batch) >= self.samples_per_frame:
+                            s.send(self.byte_str(encoder.encode(batch)))
+                            batch = []
             except KeyboardInterrupt:
                 raise
             except socket.error:
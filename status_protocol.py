@@ -0,0 +1,111 @@
+"""
+The compact status protocol, and a reference server that speaks it.
+
+After the usual handshake, a client asks for compact mode with `compact 1`; a server that supports it
+answers `Compact mode on`, and any other answer (or none) keeps the client on `update <json>` lines.
+In compact mode, each line is `frame <json list>` holding one or more samples. A sample only has the
+fields that changed since the sample before it, and lists the fields it no longer has in `"_d"`;
+a keyframe (`"_k": 1`) has every field and starts over, which is sent first on every connection and
+every `keyframe_gap` frames after.
+"""
+import json
+import socket
+import threading
+
+COMPACT_REQUEST = 'compact 1\n'
+COMPACT_REPLY = 'Compact mode on\n'
+
+
+class CompactEncoder:
+    def __init__(self, keyframe_gap=60):
+        self.keyframe_gap = keyframe_gap
+        self.n_frames = 0
+        self.last = None
+
+    def encode(self, samples):
+        # one frame line for the samples, given in order
+        if self.n_frames % self.keyframe_gap == 0:
+            self.last = None
+        self.n_frames += 1
+        deltas = list()
+        for sample in samples:
+            if self.last is None:
+                delta = dict(sample, _k=1)
+            else:
+                delta = {k: v for k, v in sample.items() if k not in self.last or self.last[k] != v}
+                removed = [k for k in self.last if k not in sample]
+                if removed:
+                    delta['_d'] = removed
+            deltas.append(delta)
+            self.last = sample
+        return 'frame ' + json.dumps(deltas, separators=(',', ':')) + '\n'
+
+
+class CompactDecoder:
+    def __init__(self):
+        self.last = None
+
+    def decode(self, line):
+        # the full samples of an `update` or `frame` line
+        command, _, payload = line.strip().partition(' ')
+        if command == 'update':
+            return [json.loads(payload)]
+        if command != 'frame':
+            raise ValueError(f'Unknown command: {command}')
+        samples = list()
+        for delta in json.loads(payload):
+            if delta.pop('_k', 0):
+                self.last = dict()
+            elif self.last is None:
+                raise ValueError('A delta before any keyframe.')
+            removed = delta.pop('_d', [])
+            self.last = dict(self.last, **delta)
+            for k in removed:
+                self.last.pop(k, None)
+            samples.append(self.last)
+        return samples
+
+
+class ReferenceServer:
+    """
+    A stand-in for the status server: it authenticates one `user:password` and collects the decoded
+    samples in `samples[user]`, for trying the client and the protocol locally.
+    """
+
+    def __init__(self, user, password, host='127.0.0.1', port=0, compact=True):
+        self.credential = f'{user}:{password}'
+        self.compact = compact
+        self.samples = dict()
+        self.n_bytes = 0
+        self.sock = socket.create_server((host, port))
+        self.port = self.sock.getsockname()[1]
+
+    def handle(self, conn, addr):
+        f = conn.makefile('r')
+        conn.sendall(b'Authentication required\n')
+        user = f.readline().strip()
+        if user != self.credential:
+            conn.sendall(b'Wrong username and/or password.\n')
+            conn.close()
+            return
+        conn.sendall(b'Authentication successful. Access granted.\n')
+        conn.sendall(f'You are connecting via: {"IPv6" if ":" in addr[0] else "IPv4"}\n'.encode())
+        decoder = CompactDecoder()
+        samples = self.samples.setdefault(user.split(':')[0], list())
+        for line in f:
+            self.n_bytes += len(line)
+            if line == COMPACT_REQUEST:
+                if self.compact:
+                    conn.sendall(COMPACT_REPLY.encode())
+                continue
+            samples.extend(decoder.decode(line))
+        conn.close()
+
+    def serve(self):
+        while True:
+            conn, addr = self.sock.accept()
+            threading.Thread(target=self.handle, args=(conn, addr), daemon=True).start()
+
+    def start(self):
+        threading.Thread(target=self.serve, daemon=True).start()
+        return self